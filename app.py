@@ -1,39 +1,87 @@
-import re, os
+import re, os, atexit, logging, threading
 from utils import *
+from pipeline import ChannelOrderedExecutor, in_channel_order, channel_key
+from outbound import SlackOutbox
+from commands import *
+from metrics import timed, MongoMetrics, watch_cache, watch_depth, render
+from logs import enable_queue_logging, fields
 
 from flask import Flask, request
 
-from slack_bolt import App
+from slack_bolt import App, BoltResponse
 from slack_bolt.adapter.flask import SlackRequestHandler
 from slack_bolt.oauth.oauth_settings import OAuthSettings
 
-from apscheduler.schedulers.background import BackgroundScheduler
+from scheduler import ReferendumScheduler
+from backfill import backfill_channel
+from indexes import ensure_indexes, check_query_plans, shard_collections
+from tenants import TenantQuotas, member_channels
+from writebehind import WriteBehind
+from archive import export_channel, import_channel
+from thumbnails import ThumbnailCache, ThumbnailWorker, make_contact_sheet
+from slack_sdk.errors import SlackApiError
+from slack_sdk import WebClient
+import click
 
 from dotenv import load_dotenv
 from flask_pymongo import PyMongo
 
-CHUM_WORDS = ["chum", "chummed", "chumming", "chums"]
 OAUTH_EXPIRATION_SECONDS = 600
 EDIT_GRACE_PERIOD_SECONDS = 60
 REFERENDUM_WINDOW_SECONDS = 86400 # change to 86400
 REFERENDUM_EXPIRATION_SECONDS = 86400 # change to 86400
-REFERENDUM_CHECK_SECONDS = 600 # Change to 600
+REFERENDUM_LEASE_SECONDS = 60
+PROCESSED_EVENT_EXPIRATION_SECONDS = 3600
+# How long past expiring a referendum that was never closed is kept
+REFERENDUM_RETENTION_SECONDS = 7 * 86400
+# Expired referenda claimed at once, and how many are tallied concurrently
+REFERENDUM_BATCH_SIZE = 50
+REFERENDUM_WORKERS = 8
 BASE = "/spotbot"
+PICS_PAGE_SIZE = 10
+GRAPH_LIST_SIZE = 5
+EVENT_WORKERS = int(os.environ.get("SPOTBOT_EVENT_WORKERS", 8))
+EVENT_QUEUE_SIZE = int(os.environ.get("SPOTBOT_EVENT_QUEUE_SIZE", 100))
+EVENT_QUEUE_TIMEOUT_SECONDS = 1
+OUTBOUND_WORKERS = 4
+OUTBOUND_QUEUE_SIZE = 1000
+# Buffer counter and image writes for this long; 0 writes them with each chum
+WRITE_BEHIND_SECONDS = float(os.environ.get("SPOTBOT_WRITE_BEHIND_SECONDS", 0))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("SPOTBOT_WRITE_BEHIND_MAX_PENDING", 1000))
+THUMBNAIL_DIRECTORY = os.environ.get("SPOTBOT_THUMBNAIL_DIRECTORY", "thumbnails")
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("SPOTBOT_THUMBNAIL_CACHE_BYTES", 256 * 1024 * 1024))
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_QUEUE_SIZE = 1000
+# Per workspace; 0 is unlimited. The command rate is per process.
+TENANT_COMMANDS_PER_MINUTE = int(os.environ.get("SPOTBOT_TENANT_COMMANDS_PER_MINUTE", 600))
+TENANT_MAX_CHUMS = int(os.environ.get("SPOTBOT_TENANT_MAX_CHUMS", 0))
 
-CHUM_PATTERN = comp(r"(\b" + r"\b)|(\b".join(CHUM_WORDS) + r"\b)")
-USER_PATTERN = re.compile(r"<@[a-zA-Z0-9]+>")
 
 APPROVED_EMOJI = "white_check_mark"
 DENIED_EMOJI = "x"
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "chumbot_intro.txt")) as file:
+    INTRO = file.read()
+
 app = Flask("app")
 app.config["MONGO_URI"] = os.environ.get("SPOTBOT_SECURE_LINK")
-mongo = PyMongo(app)
+# Importing the app does no I/O: the client connects on its first operation,
+# and the threads below are started by start_services() in each process that
+# serves requests.
+mongo = PyMongo(app, connect=False, event_listeners=[MongoMetrics()])
 db_client = mongo.cx
 chum_data = SpotDatabase(db_client)
 referendum_data = ReferendumDatabase(db_client, REFERENDUM_EXPIRATION_SECONDS)
+processed_events = ProcessedEventDatabase(db_client, PROCESSED_EVENT_EXPIRATION_SECONDS)
+leases = LeaseDatabase(db_client)
+tenant_data = TenantDatabase(db_client)
+tenant_quotas = TenantQuotas(tenant_data, TENANT_COMMANDS_PER_MINUTE, TENANT_MAX_CHUMS)
+
+installation_store = DatabaseInstallationStore(db_client)
 
 # https://slack.dev/bolt-python/concepts#authenticating-oauth
 oauth_settings = OAuthSettings(
@@ -43,6 +91,7 @@ oauth_settings = OAuthSettings(
         "channels:history",
         "chat:write",
         "files:read",
+        "files:write",
         "groups:history",
         "im:history",
         "mpim:read",
@@ -50,21 +99,66 @@ oauth_settings = OAuthSettings(
         "users.profile:read",
         "reactions:read",
         "channels:read",
-        "groups:read"
+        "groups:read",
+        "users:read"
     ],
-    installation_store=DatabaseInstallationStore(db_client),
+    installation_store=installation_store,
     state_store=DatabaseOAuthStateStore(db_client, expiration_seconds=OAUTH_EXPIRATION_SECONDS),
     install_path=f"{BASE}/install/",
     redirect_uri_path=f"{BASE}/oauth_redirect/"
 )
 
+if WRITE_BEHIND_SECONDS > 0:
+    chum_data.write_behind = WriteBehind(chum_data, WRITE_BEHIND_SECONDS, WRITE_BEHIND_MAX_PENDING)
+    watch_depth("write_behind", chum_data.write_behind)
+
+# Listeners only enqueue their work, so Bolt can run them before acking: a 
+# full queue then fails the request and Slack retries it later. 
+event_pipeline = ChannelOrderedExecutor(EVENT_WORKERS, EVENT_QUEUE_SIZE, EVENT_QUEUE_TIMEOUT_SECONDS)
+
+slack_outbox = SlackOutbox(OUTBOUND_WORKERS, OUTBOUND_QUEUE_SIZE)
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_DIRECTORY, THUMBNAIL_CACHE_BYTES)
+thumbnail_worker = ThumbnailWorker(thumbnail_cache, 
+    lambda image, digest: chum_data.session_for_loc(image["loc_id"]).set_thumbnail(image["mid"], image["url"], digest),
+    workers=THUMBNAIL_WORKERS, queue_size=THUMBNAIL_QUEUE_SIZE)
+
+watch_cache("bot_users", bot_users)
+watch_cache("display_names", display_names)
+watch_cache("installations", installation_store.cache)
+watch_cache("tenants", tenant_data.cache)
+watch_depth("event_queue", event_pipeline)
+watch_depth("slack_outbox", slack_outbox)
+watch_depth("thumbnail_queue", thumbnail_worker)
+
 bolt_app = App(
     signing_secret=os.environ.get("SPOTBOT_SIGNING_SECRET"), 
-    oauth_settings=oauth_settings
+    oauth_settings=oauth_settings,
+    process_before_response=True
 )
 
 handler = SlackRequestHandler(bolt_app)
 
+# Slack redelivers events it thinks failed (X-Slack-Retry-Num). Each event_id
+# is handled once, unless the first attempt raised before it was acked.
+@bolt_app.middleware
+def skip_processed_events(body, next):
+    if "event_id" in body and not processed_events.claim(body["event_id"]):
+        return BoltResponse(status=200, body="")
+    next()
+
+@bolt_app.error
+def release_failed_event(error, body):
+    logger.error("Encountered an exception while handling an event", exc_info=error, extra=fields(event_id=body.get("event_id")))
+    if "event_id" in body:
+        processed_events.release(body["event_id"])
+
+# Starts the services of whichever process ends up serving, in case no server
+# hook did already.
+@app.before_request
+def ensure_services():
+    start_services()
+
 @app.route(f"{BASE}/install/")
 def handle_install():
     return handler.handle(request)
@@ -77,163 +171,259 @@ def handle_oauth():
 def handle_events():
     return handler.handle(request)
 
+@app.route(f"{BASE}/metrics")
+def handle_metrics():
+    return render()
+
 @bolt_app.event("member_joined_channel")
-def joined_listener(event, body, say, client):
-    if event["user"] != get_bot_user(client):
+@in_channel_order(event_pipeline)
+@timed
+def joined_listener(event, body, client):
+    if event["user"] != get_bot_user(client, body["team_id"]):
         return 
-    with open("chumbot_intro.txt") as file:
-        say(file.read())
+    post_message(client, event["channel"], INTRO)
 
     if "inviter" not in event:
         return 
 
-    chum_data.configure_for_message(event, body)
-    chum_data.set_manager(event["inviter"])
-    chum_data.push_write()
+    with chum_data.session_for_message(event, body) as chums:
+        chums.set_manager(event["inviter"])
 
-@bolt_app.message(CHUM_PATTERN)
-def spot_listener(event, body, say, client):
+# Every plain message goes through this one listener. It is classified in a 
+# single pass, and only commands are queued for their handler. 
+@bolt_app.event({
+    "type": "message",
+    "subtype": (None, "bot_message", "thread_broadcast", "file_share")
+})
+@timed
+def message_listener(event, body, client):
+    command = classify(event.get("text"), has_files="files" in event)
+    if not command or not tenant_quotas.allow_command(body["team_id"]):
+        return
+    event_pipeline.submit(channel_key(event, body), COMMAND_LISTENERS[command.name], 
+        event=event, body=body, client=client, command=command)
+
+def post_message(client, channel, text, **kwargs):
+    slack_outbox.post(client, "chat_postMessage", channel=channel, text=text, **kwargs)
+
+@timed
+def spot_listener(event, body, client, command):
     if "files" not in event:
         return
-    chum_data.configure_for_message(event, body)
-    log_spot(event["channel"], event["user"], event["ts"], event["text"], event["files"], say, client)
-    chum_data.push_write()
+    with chum_data.session_for_message(event, body) as chums:
+        log_spot(chums, event["channel"], event["user"], event["ts"], command.mentions, event["files"], 
+            get_bot_user(client, body["team_id"]), client)
 
-# Assumes matches CHUM_PATTERN and files are present. 
-def log_spot(channel, user, ts, text, files, say, client, purged_recent=False):
+# Assumes the message is a chum command and files are present. 
+def log_spot(chums, channel, user, ts, mentions, files, bot_user, client, purged_recent=False):
     spotter = user
-    found_spotted = USER_PATTERN.findall(text)
-    found_spotted = list(set(found_spotted)) # remove duplicates
-    found_spotted = [username[2:-1] for username in found_spotted]
-    if spotter in found_spotted:
-        found_spotted.remove(spotter)
-
-    bot_user = get_bot_user(client)
-    if bot_user in found_spotted:
-        found_spotted.remove(bot_user)
-    
-    if not found_spotted:
+    found_spotted = spotted_users(mentions, spotter, bot_user)
+    if not found_spotted or not tenant_quotas.allow_chum(chums.team_id):
         return 
 
-    all_images = [image['url_private'] for image in files]
+    images = [image_from_file(file) for file in files if "url_private" in file]
+    chums.record_chum(message_id(ts), spotter, found_spotted, images, ts)
 
-    chum_data.increment_spot(spotter, len(found_spotted))
-    for spotted in found_spotted:
-        chum_data.increment_caught(spotted, 1)
-        chum_data.append_images(spotted, all_images)
+    on_fire = not purged_recent and chums.get_recent() == spotter
+    chums.set(RECENT, None if on_fire else spotter)
 
-    chum_data.add_message(message_id(ts), {
-        "spotter": spotter,
-        "spotted": found_spotted,
-        "images": all_images,
-        "ts": ts,
-        "referendum": False
-    })
-
-    if not purged_recent: 
-        recent = chum_data.get_recent()
-        if recent == spotter: 
-            say(f"<@{spotter}> is on fire 🥵")
-            chum_data.set(RECENT, None)
-        else: 
-            chum_data.set(RECENT, spotter)
-    else: 
-        chum_data.set(RECENT, spotter)
+    # Commit before talking to Slack so a redelivered chum is not announced twice.
+    if not chums.commit():
+        return
 
-    client.reactions_add(channel=channel, name=APPROVED_EMOJI, timestamp=ts)
+    if on_fire:
+        post_message(client, channel, f"<@{spotter}> is on fire 🥵")
+    slack_outbox.post(client, "reactions_add", channel=channel, name=APPROVED_EMOJI, timestamp=ts)
+    for image in images:
+        thumbnail_worker.submit(dict(image, loc_id=chums.loc_id, mid=message_id(ts)), client.token)
 
 @bolt_app.event({
     "type": "message",
     "subtype": "message_deleted"
 })
+@in_channel_order(event_pipeline)
+@timed
 def delete_listener(event, body):
-    chum_data.configure_for_message(event, body)
-    delete(message_id(event["deleted_ts"]))
-    chum_data.push_write()
-
-def delete(mid):
-    message = chum_data.delete_message(mid)
-    if not message:
-        return
-    chum_data.increment_spot(message["spotter"], -1 * len(message["spotted"]))
-    for user in message["spotted"]:
-        chum_data.increment_caught(user, -1)
-        chum_data.update_value(f"{IMAGES}.{user}", "$pull", message["images"])
-
-    chum_data.set(RECENT, None)
+    with chum_data.session_for_message(event, body) as chums:
+        chums.delete_chum(message_id(event["deleted_ts"]))
 
 @bolt_app.event({
     "type": "message",
     "subtype": "message_changed"
 })
-def changed_listener(event, body, say, client):
-    chum_data.configure_for_message(event, body)
+@in_channel_order(event_pipeline)
+@timed
+def changed_listener(event, body, client):
     inner_event = event["message"]
 
     if "files" not in inner_event:
         return
 
-    if not CHUM_PATTERN.search(inner_event["text"]):
+    command = classify(inner_event["text"], has_files=True)
+    if not command or command.name != CHUM:
         return
 
     if float(event["ts"]) - float(inner_event["ts"]) > EDIT_GRACE_PERIOD_SECONDS:
         # Only accept edits made soon after they are posted
         return 
 
-    # If spots have been counted, they must be deleted and recounted.
-    try:
-        delete(message_id(inner_event["ts"]))
-        client.reactions_remove(channel=event["channel"], name=APPROVED_EMOJI, timestamp=inner_event["ts"])
-    except Exception as e:
-        print("Encountered an exception while internally deleting a changed spot: ", e)
-
-    log_spot(event["channel"], inner_event["user"], inner_event["ts"], 
-        inner_event["text"], inner_event["files"], say, client, purged_recent=True)
-
-    chum_data.push_write()
-
-@bolt_app.message(comp("scoreboard|chumboard"))
-def scoreboard_listener(event, say, body, client):
-    try:
-        words = event['text'].lower().split()
-        n = int(words[words.index("chumboard") + 1])
-    except:
-        try:
-            n = int(words[words.index("scoreboard") + 1])
-        except:
-            n = 5
-
-    chum_data.configure_for_message(event, body)
-    spots = chum_data.get({SPOT: True})
-    if not spots:
+    with chum_data.session_for_message(event, body) as chums:
+        # If spots have been counted, they must be deleted and recounted. The 
+        # outbox drops this removal if log_spot re-adds the checkmark. 
+        chums.delete_chum(message_id(inner_event["ts"]))
+        slack_outbox.post(client, "reactions_remove", channel=event["channel"], name=APPROVED_EMOJI, timestamp=inner_event["ts"])
+
+        log_spot(chums, event["channel"], inner_event["user"], inner_event["ts"], 
+            command.mentions, inner_event["files"], get_bot_user(client, body["team_id"]), client, 
+            purged_recent=True)
+
+@timed
+def scoreboard_listener(event, body, client, command):
+    args = command.args
+
+    # Accepts a count and either "week", "month" or one or two dates, in any order:
+    # "chumboard 10", "chumboard week", "chumboard 2023-01-01 2023-01-31 10"
+    n = 5
+    window = None
+    days = []
+    for arg in args[:3]:
+        if arg.isdigit():
+            n = int(arg)
+        elif arg in ("week", "month"):
+            window = window_days(arg)
+        elif parse_day(arg):
+            days.append(parse_day(arg))
+        else:
+            break
+
+    if days:
+        start = min(days)
+        end = max(days) if len(days) > 1 else datetime.utcnow().strftime(DAY_FORMAT)
+        window = (start, end, f"{start} to {end}")
+
+    if n <= 0:
+        return
+    chums = chum_data.session_for_message(event, body)
+    if window:
+        scoreboard = chums.get_top_spotters_between(window[0], window[1], n)
+    else:
+        scoreboard = chums.get_top_spotters(n)
+    if not scoreboard:
         return 
-    spots = spots[SPOT]
-    scoreboard = sorted(spots.keys(), key=lambda p: spots[p], reverse=True)[:n]
-    message = "chumboard:\n" 
-    for i, participant in enumerate(scoreboard):
-        message += f"{i + 1}. {get_display_name(client, participant)} - {spots[participant]}\n" 
-    say(message)
-
-@bolt_app.message(comp(r"\bpics\b|\bphotos\b"))
-def pics_listener(event, say, body, client):
-    found_spotted = USER_PATTERN.search(event['text'])
-    if not found_spotted:
+    message = f"chumboard ({window[2]}):\n" if window else "chumboard:\n" 
+    for i, (participant, spots) in enumerate(scoreboard):
+        message += f"{i + 1}. {get_display_name(client, body['team_id'], participant)} - {spots}\n" 
+    post_message(client, event["channel"], message)
+
+@timed
+def pics_listener(event, body, client, command):
+    if not command.mentions:
         return
-    spotted = found_spotted[0][2:-1]
-
-    chum_data.configure_for_message(event, body)
-    images = chum_data.get({IMAGES: True})
-    if not images:
+    spotted = command.mentions[0]
+
+    # "pics @user", "pics @user page 2" or "pics @user last 10"
+    words = command.args
+    page, last = 1, None
+    for option in ("page", "last"):
+        if option in words[:-1] and words[words.index(option) + 1].isdigit():
+            value = int(words[words.index(option) + 1])
+            if option == "page":
+                page = max(value, 1)
+            else:
+                last = min(max(value, 1), PICS_PAGE_SIZE * 5)
+
+    chums = chum_data.session_for_message(event, body)
+    total = chums.count_images(spotted)
+    if not total:
         return 
-    images = images[IMAGES]
 
-    message = f"Spots of {get_display_name(client, spotted)}:\n"
-    for i, link in enumerate(images[spotted]):
-        message += f"{i + 1}. {link}\n"
-    say(message)
+    name = get_display_name(client, body['team_id'], spotted)
+    if last:
+        images = chums.get_images(spotted, limit=last, newest_first=True)[::-1]
+        first = total - len(images)
+        title = f"Latest spots of {name}:"
+    else:
+        pages = (total + PICS_PAGE_SIZE - 1) // PICS_PAGE_SIZE
+        page = min(page, pages)
+        first = (page - 1) * PICS_PAGE_SIZE
+        images = chums.get_image_page(spotted, first, PICS_PAGE_SIZE, total)
+        title = f"Spots of {name} (page {page} of {pages}):" if pages > 1 else f"Spots of {name}:"
+
+    hint = None
+    if not last and page < pages:
+        # A real mention, not the display name, so the command works as written.
+        # Not in code spans, where Slack would show the mention's raw text.
+        hint = f"Send _pics <@{spotted}> page {page + 1}_ for more, or _pics <@{spotted}> last 10_ for the newest."
+    if post_contact_sheet(client, event["channel"], chums, images, first, title if not hint else f"{title}\n{hint}"):
+        return
+
+    lines = [f"{first + i + 1}. {image['url']}" for i, image in enumerate(images)]
+    blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": title}}]
+    # Section text is capped at 3000 characters
+    chunk = ""
+    for line in lines:
+        if len(chunk) + len(line) + 1 > 3000:
+            blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": chunk}})
+            chunk = ""
+        chunk += line + "\n"
+    if chunk:
+        blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": chunk}})
+    if hint:
+        blocks.append({"type": "context", "elements": [{"type": "mrkdwn", "text": hint}]})
+    post_message(client, event["channel"], title, blocks=blocks)
+
+# Uploads the images as one numbered grid of thumbnails. Returns False, so the
+# caller lists links instead, while any thumbnail is still being made (it is
+# queued here) or if the upload fails, e.g. for installs without files:write.
+def post_contact_sheet(client, channel, chums, images, first, comment):
+    thumbnails = [thumbnail_cache.get(image["thumbnail"]) if "thumbnail" in image else None for image in images]
+    missing = [image for image, thumbnail in zip(images, thumbnails) if thumbnail is None]
+    for image in missing:
+        thumbnail_worker.submit(dict(image, loc_id=chums.loc_id), client.token)
+    if missing:
+        return False
 
-@bolt_app.message(comp(r"\breferendum\b"))
-def referendum_listener(event, say, body, client):
+    try:
+        slack_outbox.call(client, "files_upload_v2", channel=channel, file=make_contact_sheet(thumbnails, first + 1),
+            filename="pics.jpg", title="pics", initial_comment=comment)
+    except SlackApiError as e:
+        logger.warning("Couldn't upload a contact sheet", extra=fields(error=e.response.get("error")))
+        return False
+    except OSError:
+        logger.exception("Couldn't upload a contact sheet")
+        return False
+    return True
+
+@timed
+def graph_listener(event, body, client, command):
+    user = command.mentions[0] if command.mentions else event["user"]
+    chums = chum_data.session_for_message(event, body)
+    name = lambda other: get_display_name(client, body['team_id'], other)
+    listing = lambda edges: ", ".join(f"{name(other)} ({count})" for other, count in edges) or "nobody yet"
+
+    mutual = chums.get_mutual_chums(user)
+    message = f"Chums of {name(user)}:\n"
+    message += f"Chummed most: {listing(chums.get_edges(user, outgoing=True, limit=GRAPH_LIST_SIZE))}\n"
+    message += f"Chummed by most: {listing(chums.get_edges(user, outgoing=False, limit=GRAPH_LIST_SIZE))}\n"
+    message += f"Mutual chums: {len(mutual)}\n"
+    post_message(client, event["channel"], message)
+
+@timed
+def rivals_listener(event, body, client, command):
+    n = next((int(arg) for arg in command.args if arg.isdigit()), GRAPH_LIST_SIZE)
+    if n <= 0:
+        return
+    pairs = chum_data.session_for_message(event, body).get_top_pairs(n)
+    if not pairs:
+        return
+    name = lambda other: get_display_name(client, body['team_id'], other)
+    message = "Top chum pairs:\n"
+    for i, (spotter, spotted, count) in enumerate(pairs):
+        message += f"{i + 1}. {name(spotter)} → {name(spotted)} - {count}\n"
+    post_message(client, event["channel"], message)
+
+@timed
+def referendum_listener(event, body, client, command):
     if "thread_ts" not in event:
         return
 
@@ -241,14 +431,14 @@ def referendum_listener(event, say, body, client):
         # Only accept referendums that open within a certain window
         return 
 
-    chum_data.configure_for_message(event, body)
     mid = message_id(event["thread_ts"])
-    result = chum_data.set_referendum(mid, True)
+    result = chum_data.session_for_message(event, body).set_referendum(mid, True)
     if result is not False:
         return 
 
-    referendum_post = say(
-        text = f"Good chum :+1: or bad chum :-1:? ", 
+    referendum_post = slack_outbox.call(client, "chat_postMessage",
+        channel = event["channel"],
+        text = REFERENDUM_PROMPT, 
         thread_ts = event['thread_ts'],
         reply_broadcast = True
     )
@@ -262,62 +452,222 @@ def referendum_listener(event, say, body, client):
         "date": datetime.utcnow()
     })
 
-    client.reactions_add(channel=referendum_post["channel"], name="+1", timestamp=referendum_post["ts"])
-    client.reactions_add(channel=referendum_post["channel"], name="-1", timestamp=referendum_post["ts"])
+    slack_outbox.post(client, "reactions_add", channel=referendum_post["channel"], name="+1", timestamp=referendum_post["ts"])
+    slack_outbox.post(client, "reactions_add", channel=referendum_post["channel"], name="-1", timestamp=referendum_post["ts"])
 
-@bolt_app.message(comp(r"\breset\b"))
-def reset_listener(event, say, body, client):
-    chum_data.configure_for_message(event, body)
-    manager = chum_data.get_manager()
+@timed
+def reset_listener(event, body, client, command):
+    chums = chum_data.session_for_message(event, body)
+    manager = chums.get_manager()
     if event["user"] != manager: 
-        say("Only the person who invited Chum Bot to the channel can perform that action. ")
+        post_message(client, event["channel"], "Only the person who invited Chum Bot to the channel can perform that action. ")
         return 
 
     if not re.search("reset yes i mean it really delete everything", event["text"], re.IGNORECASE):
-        say("If you really want to delete every chum in this channel, please send \"reset yes i mean it really delete everything\". This action cannot be undone.")
+        post_message(client, event["channel"], "If you really want to delete every chum in this channel, please send \"reset yes i mean it really delete everything\". This action cannot be undone.")
         return
     
-    say("Resetting the chum record. ")
-    chum_data.drop_loc(manager)
-
-def process_referenda():
-    for referendum in referendum_data.expired_referenda(): 
-        try: 
-            process_referendum(referendum)
-        except Exception as e:
-            print("Encountered an exception while processing expired referenda: ", e)
-
-def process_referendum(referendum):
-    bot = bolt_app.installation_store.find_installation(team_id=referendum["team_id"], enterprise_id=None, user_id=None, is_enterprise_install=None)
-    result = bolt_app.client.reactions_get(token=bot.bot_token, channel=referendum["channel_id"], timestamp=referendum["vote_ts"])
-    yes_votes = set()
-    no_votes = set()
-    for reaction in result["message"]["reactions"]:
-        names = reaction["name"].split("::")
-        if names[0] == "+1" or names[0] == "thumbsup":
-            ledger = yes_votes
-        elif names[0] == "-1" or names[0] == "thumbsdown":
-            ledger = no_votes
-        else: 
+    post_message(client, event["channel"], "Resetting the chum record. ")
+    chums.drop_loc(manager)
+
+COMMAND_LISTENERS = {
+    CHUM: spot_listener,
+    SCOREBOARD: scoreboard_listener,
+    PICS: pics_listener,
+    CHUMS: graph_listener,
+    RIVALS: rivals_listener,
+    REFERENDUM: referendum_listener,
+    RESET: reset_listener
+}
+
+YES_VOTES = {"+1", "thumbsup"}
+NO_VOTES = {"-1", "thumbsdown"}
+
+# (yes, no) voter counts. A user is counted once per side even when they
+# reacted with several skin tones of it. Each side keeps the first reaction's
+# user list as is and only builds a set once a second variant shows up.
+def tally_votes(reactions):
+    voters = {True: None, False: None}
+    for reaction in reactions:
+        name = reaction["name"].split("::")[0]
+        if name not in YES_VOTES and name not in NO_VOTES:
             continue
-        for user in reaction["users"]:
-            ledger.add(user)
-
-    if len(yes_votes) >= len(no_votes): 
-        bolt_app.client.chat_postMessage(token=bot.bot_token, channel=referendum["channel_id"], thread_ts=referendum["spot_ts"], text="The chum is good! ")
+        side = name in YES_VOTES
+        if voters[side] is None:
+            voters[side] = reaction["users"]
+        else:
+            if not isinstance(voters[side], set):
+                voters[side] = set(voters[side])
+            voters[side].update(reaction["users"])
+    return tuple(len(voters[side] or ()) for side in (True, False))
+
+def find_bot(team_id):
+    bot = installation_store.find_installation(team_id=team_id, enterprise_id=None, user_id=None, is_enterprise_install=None)
+    if not bot:
+        raise LookupError(f"Team {team_id} is not installed")
+    return bot
+
+@timed
+def process_referendum(referendum, bot):
+    result = slack_outbox.call(bolt_app.client, "reactions_get", token=bot.bot_token, channel=referendum["channel_id"], timestamp=referendum["vote_ts"])
+    yes_votes, no_votes = tally_votes(result["message"].get("reactions", []))
+
+    if yes_votes >= no_votes: 
+        post_message(bolt_app.client, referendum["channel_id"], CHUM_IS_GOOD, token=bot.bot_token, thread_ts=referendum["spot_ts"])
         return 
 
-    chum_data.configure_for_loc(referendum["loc_id"])
-    delete(message_id(referendum["spot_ts"]))
-    chum_data.push_write()
-    bolt_app.client.reactions_remove(token=bot.bot_token, channel=referendum["channel_id"], name=APPROVED_EMOJI, timestamp=referendum["spot_ts"])
-    bolt_app.client.reactions_add(token=bot.bot_token, channel=referendum["channel_id"], name=DENIED_EMOJI, timestamp=referendum["spot_ts"])
-    bolt_app.client.chat_postMessage(token=bot.bot_token, channel=referendum["channel_id"], thread_ts=referendum["spot_ts"], text="The chum is bad. ")
-
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=process_referenda, trigger="interval", seconds=REFERENDUM_CHECK_SECONDS)
-scheduler.start()
-process_referenda()
+    with chum_data.session_for_loc(referendum["loc_id"]) as chums:
+        chums.delete_chum(message_id(referendum["spot_ts"]))
+    slack_outbox.post(bolt_app.client, "reactions_remove", token=bot.bot_token, channel=referendum["channel_id"], name=APPROVED_EMOJI, timestamp=referendum["spot_ts"])
+    slack_outbox.post(bolt_app.client, "reactions_add", token=bot.bot_token, channel=referendum["channel_id"], name=DENIED_EMOJI, timestamp=referendum["spot_ts"])
+    post_message(bolt_app.client, referendum["channel_id"], CHUM_IS_BAD, token=bot.bot_token, thread_ts=referendum["spot_ts"])
+
+scheduler = ReferendumScheduler(referendum_data, leases, find_bot, process_referendum, REFERENDUM_LEASE_SECONDS,
+    batch_size=REFERENDUM_BATCH_SIZE, workers=REFERENDUM_WORKERS)
+
+def create_indexes():
+    ensure_indexes(db_client, OAUTH_EXPIRATION_SECONDS, PROCESSED_EVENT_EXPIRATION_SECONDS, 
+        REFERENDUM_EXPIRATION_SECONDS + REFERENDUM_RETENTION_SECONDS)
+
+# Runs in the background once a process starts serving: reads the thumbnail
+# cache, opens the connection pool, then creates missing indexes and checks
+# the hot queries use them.
+def warm_up():
+    try:
+        thumbnail_cache.load()
+        db_client.admin.command("ping")
+        create_indexes()
+        check_query_plans(db_client)
+    except Exception:
+        logger.exception("Encountered an exception while warming up")
+
+services_started = False
+services_lock = threading.Lock()
+
+# Starts the background threads. Threads don't survive a fork, so under
+# gunicorn --preload this runs in each worker (see gunicorn.conf.py), not at
+# import. Safe to call more than once.
+def start_services():
+    global services_started
+    if services_started:
+        return
+    with services_lock:
+        if services_started:
+            return
+        atexit.register(enable_queue_logging().stop)
+        if chum_data.write_behind:
+            chum_data.write_behind.start()
+            # Registered before the pipeline so it flushes after the last queued event
+            atexit.register(chum_data.write_behind.stop)
+        # Exit handlers run in reverse, so the outbox is registered before the
+        # pipeline and stops after it has drained and queued its replies.
+        slack_outbox.start()
+        atexit.register(slack_outbox.shutdown)
+        event_pipeline.start()
+        atexit.register(event_pipeline.shutdown)
+        thumbnail_worker.start()
+        atexit.register(thumbnail_worker.shutdown)
+        scheduler.start()
+        atexit.register(scheduler.stop)
+        threading.Thread(target=warm_up, daemon=True).start()
+        services_started = True
+
+@bolt_app.event("user_change")
+def user_change_listener(event, body):
+    display_names.invalidate((body["team_id"], event["user"]["id"]))
+
+@bolt_app.event("tokens_revoked")
+@bolt_app.event("app_uninstalled")
+def revoked_listener(event, body):
+    bot_users.invalidate(body["team_id"])
+    display_names.invalidate_where(lambda key: key[0] == body["team_id"])
+    installation_store.invalidate_team(body["team_id"])
+
+@app.cli.command("migrate-storage")
+def migrate_storage():
+    create_indexes()
+    migrated = chum_data.migrate_legacy_locations()
+    print(f"Migrated {migrated} channels to the normalized chum collections. ")
+
+# One-shot move of every channel's data to team-prefixed location ids. The
+# old ids are hashes, so each workspace's channels are listed from Slack to
+# find them. Run it once while deploying, before the new listeners take
+# traffic. Channels the bot has left are reported and left as they are.
+@app.cli.command("migrate-tenants")
+def migrate_tenants():
+    create_indexes()
+    for team_id in installation_store.team_ids():
+        try:
+            client = WebClient(token=find_bot(team_id).bot_token, base_url=bolt_app.client.base_url)
+            channels = list(member_channels(slack_outbox, client))
+        except (LookupError, SlackApiError) as e:
+            print(f"Skipped {team_id}: {e}")
+            continue
+        moved = 0
+        for channel in channels:
+            ids = ({"channel": channel}, {"team_id": team_id})
+            old, new = legacy_location_identifier(*ids), unique_location_identifier(*ids)
+            if chum_data.rename_location(old, new):
+                moved += 1
+        usage = tenant_data.recount(team_id)
+        print(f"Moved {moved} channels of {team_id} ({usage['chums']} chums). ")
+    left = chum_data.collection.count_documents({"loc_id": {"$not": {"$regex": TEAM_SEPARATOR}}})
+    if left:
+        print(f"{left} channels were not found in any workspace and keep their old ids. ")
+
+@app.cli.command("tenant-stats")
+@click.argument("team_id", required=False)
+@click.option("--top", default=10, help="How many of the largest workspaces to list.")
+@click.option("--recount", is_flag=True, help="Recompute the workspace's totals first.")
+def tenant_stats_command(team_id, top, recount):
+    if not team_id:
+        for usage in tenant_data.get_top(top):
+            print(f"{usage['team_id']}: {usage.get('chums', 0)} chums, {usage.get('images', 0)} images")
+        return
+    usage = tenant_data.recount(team_id) if recount else tenant_data.get_usage(team_id)
+    print(f"{team_id}: {usage.get('chums', 0)} chums, {usage.get('images', 0)} images, "
+        f"{tenant_data.count_channels(team_id)} channels, {referendum_data.count_open(team_id)} open referenda")
+
+@app.cli.command("shard")
+def shard_command():
+    create_indexes()
+    shard_collections(db_client)
+    print("Sharded the chum collections by workspace. ")
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    create_indexes()
+    check_query_plans(db_client)
+    print("Every hot query is served by an index. ")
+
+@app.cli.command("backfill")
+@click.argument("team_id")
+@click.argument("channel")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint of an interrupted run.")
+def backfill_command(team_id, channel, restart):
+    create_indexes()
+    bot = installation_store.find_installation(team_id=team_id, enterprise_id=None)
+    client = WebClient(token=bot.bot_token, base_url=bolt_app.client.base_url)
+    count = backfill_channel(chum_data, slack_outbox, client, team_id, channel, get_bot_user(client, team_id), restart)
+    print(f"Rebuilt {count} chums in {channel}. ")
+
+@app.cli.command("export")
+@click.argument("team_id")
+@click.argument("channel")
+@click.argument("path")
+def export_command(team_id, channel, path):
+    count = export_channel(chum_data, unique_location_identifier({"channel": channel}, {"team_id": team_id}), path)
+    print(f"Exported {count} chums from {channel} to {path}. ")
+
+@app.cli.command("import")
+@click.argument("team_id")
+@click.argument("channel")
+@click.argument("path")
+@click.option("--replace", is_flag=True, help="Delete the channel's chums before importing.")
+def import_command(team_id, channel, path, replace):
+    create_indexes()
+    count = import_channel(chum_data, unique_location_identifier({"channel": channel}, {"team_id": team_id}), path, replace)
+    print(f"Imported {count} chums from {path} into {channel}. ")
 
 @bolt_app.event("file_shared")
 @bolt_app.event("message")
@@ -0,0 +1,55 @@
+from backfill import BATCH_SIZE, commit_chums
+from datetime import datetime
+import gzip, json
+
+FORMAT = "chum-bot-channel"
+VERSION = 1
+EXPORTED_FIELDS = ["mid", "spotter", "spotted", "ts", "images", "referendum"]
+
+
+# Streams a channel's chums, oldest first, to a gzipped JSON-lines file: a
+# header line, then one line per chum. Only one cursor batch is held in
+# memory. Returns the number of chums written.
+def export_channel(database, loc_id, path):
+    chums = database.session_for_loc(loc_id)
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        file.write(json.dumps({
+            "format": FORMAT,
+            "version": VERSION,
+            "manager": chums.get_manager(),
+            "exported_at": datetime.utcnow().isoformat()
+        }) + "\n")
+        for chum in chums.iter_chums():
+            file.write(json.dumps({field: chum.get(field) for field in EXPORTED_FIELDS}, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+# Rebuilds a channel from an export, recounting spots, catches, rollups,
+# edges and images through record_chum in batches of BATCH_SIZE. The channel
+# must be empty unless replace is set, which clears it first. A chum repeated
+# in the file is imported once. Returns the number of chums imported.
+def import_channel(database, loc_id, path, replace=False):
+    chums = database.session_for_loc(loc_id, write_behind=False)
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        header = json.loads(next(file))
+        if header.get("format") != FORMAT or header.get("version") != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} channel export")
+        if replace:
+            chums.drop_loc(header["manager"] or chums.get_manager())
+        elif chums.count_chums():
+            raise ValueError("The channel already has chums; pass replace to overwrite them")
+        elif header["manager"] and not chums.get_manager():
+            chums.set_manager(header["manager"])
+            chums.commit()
+
+        count = 0
+        batch = []
+        for line in file:
+            chum = json.loads(line)
+            batch.append((chum["mid"], chum["spotter"], chum["spotted"], chum["images"], chum["ts"], chum["referendum"]))
+            if len(batch) >= BATCH_SIZE:
+                count += commit_chums(chums, batch)
+                batch = []
+        count += commit_chums(chums, batch)
+    return count
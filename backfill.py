@@ -0,0 +1,105 @@
+from commands import classify, spotted_users, CHUM
+from utils import unique_location_identifier, message_id, image_from_file, RECENT, REFERENDUM_PROMPT, CHUM_IS_BAD
+
+HISTORY_PAGE_SIZE = 200
+BATCH_SIZE = 500
+COMMIT_ATTEMPTS = 3
+REPLAYED_SUBTYPES = (None, "file_share", "thread_broadcast")
+
+
+# Yields a channel's messages newest first, one page in memory at a time,
+# starting just before the `latest` timestamp if given.
+def channel_history(outbox, client, channel, latest=None):
+    cursor = None
+    while True:
+        page = outbox.call(client, "conversations_history", channel=channel, latest=latest,
+            limit=HISTORY_PAGE_SIZE, cursor=cursor)
+        for message in page["messages"]:
+            yield message
+        cursor = page.get("response_metadata", {}).get("next_cursor")
+        if not page.get("has_more") or not cursor:
+            return
+
+# Returns (whether a referendum was held, whether it rejected the chum) by
+# reading the bot's replies in the chum's thread.
+def referendum_outcome(outbox, client, channel, ts, bot_user):
+    held = rejected = False
+    cursor = None
+    while True:
+        page = outbox.call(client, "conversations_replies", channel=channel, ts=ts,
+            limit=HISTORY_PAGE_SIZE, cursor=cursor)
+        for reply in page["messages"]:
+            if reply.get("user") != bot_user:
+                continue
+            held = held or reply.get("text") == REFERENDUM_PROMPT
+            rejected = rejected or reply.get("text") == CHUM_IS_BAD
+        cursor = page.get("response_metadata", {}).get("next_cursor")
+        if not page.get("has_more") or not cursor:
+            return held, rejected
+
+# Returns the record_chum arguments log_spot would have used for the
+# message, or None if it did not count as a chum.
+def replay(outbox, client, channel, message, bot_user):
+    if message.get("subtype") not in REPLAYED_SUBTYPES or "files" not in message:
+        return None
+    command = classify(message.get("text"), has_files=True)
+    if not command or command.name != CHUM:
+        return None
+    spotted = spotted_users(command.mentions, message.get("user"), bot_user)
+    if not spotted:
+        return None
+
+    held = False
+    if message.get("reply_count"):
+        held, rejected = referendum_outcome(outbox, client, channel, message["ts"], bot_user)
+        if rejected:
+            return None
+
+    images = [image_from_file(file) for file in message["files"] if "url_private" in file]
+    return message_id(message["ts"]), message["user"], spotted, images, message["ts"], held
+
+# Records and commits a batch of record_chum arguments, skipping chums
+# already logged in the channel or repeated in the batch, e.g. one a listener
+# logged while the batch was read. finish(count) plans the writes that go
+# with the batch, such as its checkpoint. Returns the number of distinct
+# chums in the batch, all of which are logged once it returns.
+def commit_chums(chums, batch, finish=None):
+    mids = {arguments[0] for arguments in batch}
+    for _ in range(COMMIT_ATTEMPTS):
+        logged = chums.get_logged(mids)
+        for arguments in batch:
+            if arguments[0] not in logged:
+                logged.add(arguments[0])
+                chums.record_chum(*arguments)
+        if finish:
+            finish(len(mids))
+        # False if a listener logged one of them in between
+        if chums.commit():
+            return len(mids)
+    raise RuntimeError(f"Chums kept being logged elsewhere while committing a batch of {len(batch)}")
+
+# Rebuilds a channel's chums from its Slack history, committing every
+# BATCH_SIZE chums together with a checkpoint. An interrupted run resumes
+# from its checkpoint unless restart is set. Returns the number of chums.
+def backfill_channel(database, outbox, client, team_id, channel, bot_user, restart=False):
+    loc_id = unique_location_identifier({"channel": channel}, {"team_id": team_id})
+    checkpoint = None if restart else database.get_checkpoint(loc_id)
+    chums = database.session_for_loc(loc_id, write_behind=False)
+    if checkpoint:
+        latest, count = checkpoint["latest"], checkpoint["count"]
+    else:
+        chums.drop_loc(chums.get_manager())
+        latest, count = None, 0
+
+    batch = []
+    for message in channel_history(outbox, client, channel, latest):
+        chum = replay(outbox, client, channel, message, bot_user)
+        if chum:
+            batch.append(chum)
+        if len(batch) >= BATCH_SIZE:
+            count += commit_chums(chums, batch, lambda batch_count: chums.save_checkpoint(message["ts"], count + batch_count))
+            batch = []
+
+    count += commit_chums(chums, batch, lambda _: chums.set(RECENT, None))
+    database.clear_checkpoint(loc_id)
+    return count
@@ -0,0 +1,395 @@
+# Replays Slack event streams through the /spotbot/events/ route against local
+# stand-ins for Mongo and the Slack Web API, and reports handler latency,
+# throughput, Mongo operations and Slack calls per event. It first times the
+# app's cold start, and ends by closing a backlog of expired referenda, as
+# after an outage.
+#
+#   python benchmark.py                          # mongomock, default sizes
+#   python benchmark.py --mongo-uri mongodb://localhost:27017 --sizes 50:10000
+#   python benchmark.py --record events.jsonl    # save the generated stream
+#   python benchmark.py --replay events.jsonl    # replay a recorded stream
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import argparse, hashlib, hmac, io, json, os, random, sys, tempfile, threading, time
+
+SIGNING_SECRET = "benchmark-signing-secret"
+TEAM_ID = "TBENCH"
+BOT_USER = "UBENCHBOT"
+BOT_TOKEN = "xoxb-benchmark"
+# Outbox limit used unless --rate-limits keeps Slack's real ones
+UNLIMITED_PER_MINUTE = 10 ** 9
+
+# Share of each kind of event in a generated stream
+EVENT_MIX = [
+    ("chum", 50),
+    ("chatter", 20),
+    ("chumboard", 8),
+    ("pics", 6),
+    ("edit", 6),
+    ("delete", 5),
+    ("referendum", 5),
+]
+
+
+# Answers Web API calls like Slack would, counting them by method.
+class FakeSlack():
+    def __init__(self, latency_seconds):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8", "replace")
+                try:
+                    args = json.loads(raw)
+                except ValueError:
+                    args = {key: values[0] for key, values in parse_qs(raw).items()}
+                method = self.path.rstrip("/").split("/")[-1]
+                with fake.lock:
+                    fake.calls[method] += 1
+                time.sleep(latency_seconds)
+                body = json.dumps(fake.respond(method, args)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/api/"
+
+    def respond(self, method, args):
+        if method == "auth.test":
+            return {"ok": True, "user_id": BOT_USER, "team_id": TEAM_ID, "bot_id": "BBENCH"}
+        if method == "users.profile.get":
+            return {"ok": True, "profile": {"display_name": f"user {args.get('user')}", "real_name": ""}}
+        if method == "chat.postMessage":
+            return {"ok": True, "channel": args.get("channel"), "ts": f"{time.time():.6f}"}
+        if method == "files.getUploadURLExternal":
+            return {"ok": True, "upload_url": self.base_url + "upload", "file_id": f"F{time.time_ns()}"}
+        if method == "files.completeUploadExternal":
+            return {"ok": True, "files": [{"id": file["id"]} for file in json.loads(args.get("files", "[]"))]}
+        if method == "files.info":
+            return {"ok": True, "file": {"id": args.get("file")}}
+        if method == "reactions.get":
+            return {"ok": True, "message": {"reactions": [
+                {"name": "+1", "users": [BOT_USER, "UVOTER1", "UVOTER2"]},
+                {"name": "+1::skin-tone-2", "users": ["UVOTER1"]},
+                {"name": "-1", "users": [BOT_USER, "UVOTER3"]}
+            ]}}
+        return {"ok": True}
+
+    def total(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+# Counts Mongo operations, through command monitoring on a real server or by
+# wrapping mongomock's collection methods.
+class MongoCounter():
+    MOCKED_METHODS = ["find", "find_one", "insert_one", "insert_many", "bulk_write", "update_one",
+        "replace_one", "delete_one", "delete_many", "find_one_and_update", "find_one_and_delete",
+        "count_documents", "aggregate", "create_index"]
+
+    def __init__(self):
+        self.operations = 0
+        self.lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            self.operations += 1
+
+    # mongomock implements some methods with others (bulk_write calls
+    # insert_one...), so only the outermost call on each thread is counted.
+    def install_mock(self, collection_class):
+        calling = threading.local()
+        for name in self.MOCKED_METHODS:
+            method = getattr(collection_class, name)
+            def counted(*args, __method=method, **kwargs):
+                if getattr(calling, "active", False):
+                    return __method(*args, **kwargs)
+                self.count()
+                calling.active = True
+                try:
+                    return __method(*args, **kwargs)
+                finally:
+                    calling.active = False
+            setattr(collection_class, name, counted)
+
+    def install_monitoring(self):
+        from pymongo import monitoring
+        counter = self
+
+        class Listener(monitoring.CommandListener):
+            def started(self, event):
+                counter.count()
+            def succeeded(self, event):
+                pass
+            def failed(self, event):
+                pass
+
+        monitoring.register(Listener())
+
+
+# Stands in for downloading a chum's image from Slack.
+def fake_image(url, token):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new("RGB", (1024, 768), tuple(hashlib.sha256(url.encode("utf-8")).digest()[:3])).save(output, "JPEG")
+    return output.getvalue()
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def signed_post(client, payload):
+    body = json.dumps(payload)
+    timestamp = str(int(time.time()))
+    signature = "v0=" + hmac.new(SIGNING_SECRET.encode("utf-8"), f"v0:{timestamp}:{body}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return client.post("/spotbot/events/", data=body, headers={
+        "Content-Type": "application/json",
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": signature
+    })
+
+def envelope(event, sequence):
+    return {
+        "type": "event_callback",
+        "team_id": TEAM_ID,
+        "api_app_id": "ABENCH",
+        "event_id": f"Ev{sequence:012d}{random.getrandbits(32):08x}",
+        "event_time": int(time.time()),
+        "authorizations": [{"team_id": TEAM_ID, "user_id": BOT_USER, "is_bot": True}],
+        "event": event
+    }
+
+# Yields a synthetic event stream for a channel with `members` people.
+def generate_events(channel, members, count, seed):
+    rng = random.Random(seed)
+    users = [f"U{channel}{i:05d}" for i in range(members)]
+    kinds = [kind for kind, weight in EVENT_MIX for _ in range(weight)]
+    chums = []
+    clock = time.time()
+    for _ in range(count):
+        clock += 1
+        ts = f"{clock:.6f}"
+        kind = rng.choice(kinds)
+        user = rng.choice(users)
+        if kind in ("edit", "delete", "referendum") and not chums:
+            kind = "chum"
+        if kind == "chum":
+            spotted = " ".join(f"<@{other}>" for other in rng.sample(users, min(len(users), rng.randint(1, 3))))
+            event = {"type": "message", "channel": channel, "user": user, "ts": ts, "text": f"chum {spotted}",
+                "files": [{"id": f"F{ts}", "url_private": f"https://files.example/{ts}.jpg"}]}
+            chums.append(event)
+        elif kind == "chatter":
+            event = {"type": "message", "channel": channel, "user": user, "ts": ts, "text": "lunch anyone?"}
+        elif kind == "chumboard":
+            event = {"type": "message", "channel": channel, "user": user, "ts": ts, "text": rng.choice(["chumboard", "chumboard 20", "chumboard week"])}
+        elif kind == "pics":
+            event = {"type": "message", "channel": channel, "user": user, "ts": ts, "text": f"pics <@{rng.choice(users)}>"}
+        elif kind == "edit":
+            original = chums[-1]
+            event = {"type": "message", "subtype": "message_changed", "channel": channel, "ts": f"{float(original['ts']) + 5:.6f}",
+                "message": dict(original, text=original["text"] + f" <@{rng.choice(users)}>")}
+        elif kind == "delete":
+            original = chums.pop(rng.randrange(len(chums)))
+            event = {"type": "message", "subtype": "message_deleted", "channel": channel, "ts": ts, "deleted_ts": original["ts"]}
+        else:
+            event = {"type": "message", "channel": channel, "user": user, "ts": ts, "thread_ts": rng.choice(chums)["ts"], "text": "referendum"}
+        yield kind, event
+
+# Writes `history` chums straight to the database so the channel starts at size.
+def seed_history(app, channel, members, history, seed):
+    rng = random.Random(seed)
+    users = [f"U{channel}{i:05d}" for i in range(members)]
+    chums = app.chum_data.session_for_loc(app.unique_location_identifier({"channel": channel}, {"team_id": TEAM_ID}))
+    clock = time.time() - history
+    for i in range(history):
+        ts = f"{clock + i:.6f}"
+        spotter = rng.choice(users)
+        spotted = [user for user in rng.sample(users, min(len(users), 2)) if user != spotter] or [users[0]]
+        chums.record_chum(app.message_id(ts), spotter, spotted, [f"https://files.example/{ts}.jpg"], ts)
+        if i % 1000 == 999:
+            chums.commit()
+    chums.commit()
+
+def wait_until_idle(app):
+    app.event_pipeline.join()
+    while app.slack_outbox.depth():
+        time.sleep(0.005)
+
+def load_app(args, slack, mongo):
+    os.environ.update(
+        SPOTBOT_SECURE_LINK=args.mongo_uri or "mongodb://localhost:27017/benchmark",
+        SPOTBOT_CLIENT_ID="benchmark",
+        SPOTBOT_CLIENT_SECRET="benchmark",
+        SPOTBOT_SIGNING_SECRET=SIGNING_SECRET,
+        SPOTBOT_THUMBNAIL_DIRECTORY=tempfile.mkdtemp(prefix="spotbot-benchmark-")
+    )
+    if args.mongo_uri:
+        mongo.install_monitoring()
+    else:
+        import mongomock, flask_pymongo
+        flask_pymongo.MongoClient = mongomock.MongoClient
+        mongo.install_mock(mongomock.collection.Collection)
+
+    if not args.rate_limits:
+        os.environ["SPOTBOT_TENANT_COMMANDS_PER_MINUTE"] = "0"
+        import outbound
+        outbound.METHOD_LIMITS_PER_MINUTE = {}
+        outbound.DEFAULT_LIMIT_PER_MINUTE = UNLIMITED_PER_MINUTE
+
+    import app
+    app.bolt_app.client.base_url = slack.base_url
+    app.thumbnail_worker.fetch = fake_image
+    return app
+
+def install(app):
+    installation = {"app_id": "ABENCH", "team_id": TEAM_ID, "bot_token": BOT_TOKEN, "bot_id": "BBENCH",
+        "bot_user_id": BOT_USER, "user_id": "UINSTALLER", "installed_at": time.time(), "is_enterprise_install": False}
+    config = app.db_client.get_database(app.CONFIG_DATABASE_NAME)
+    config.get_collection(app.INSTALL_COLLECTION_NAME).insert_one(dict(installation))
+    config.get_collection(app.BOT_COLLECTION_NAME).insert_one(dict(installation))
+
+# Times importing the app and answering its first request, which starts the
+# background services, as a freshly started instance would.
+def measure_startup(args, slack, mongo):
+    start = time.perf_counter()
+    app = load_app(args, slack, mongo)
+    imported = time.perf_counter() - start
+    import_operations = mongo.operations
+    response = signed_post(app.app.test_client(), {"type": "url_verification", "token": "benchmark", "challenge": "ready"})
+    ready = time.perf_counter() - start
+    if response.status_code != 200:
+        print(f"The first request was answered with {response.status_code}", file=sys.stderr)
+    print("\n== startup")
+    print(f"imported in {imported * 1000:.0f} ms with {import_operations} Mongo ops, first request answered after {ready * 1000:.0f} ms")
+    return app
+
+# Times each queued handler by wrapping what the listeners submit.
+def time_handlers(app, latencies):
+    submit = app.event_pipeline.submit
+    def timed_submit(key, function, *args, **kwargs):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                latencies[function.__name__].append(time.perf_counter() - start)
+        timed.__name__ = function.__name__
+        return submit(key, timed, *args, **kwargs)
+    app.event_pipeline.submit = timed_submit
+
+def run(app, client, slack, mongo, events, latencies):
+    latencies.clear()
+    acks = []
+    mongo_before, slack_before = mongo.operations, slack.total()
+    start = time.perf_counter()
+    for sequence, (kind, event) in enumerate(events):
+        sent = time.perf_counter()
+        response = signed_post(client, envelope(event, sequence))
+        acks.append(time.perf_counter() - sent)
+        if response.status_code != 200:
+            print(f"{kind} event was answered with {response.status_code}", file=sys.stderr)
+    wait_until_idle(app)
+    elapsed = time.perf_counter() - start
+    return {
+        "events": len(acks),
+        "events_per_second": len(acks) / elapsed,
+        "ack_p50_ms": percentile(acks, 0.5) * 1000,
+        "ack_p99_ms": percentile(acks, 0.99) * 1000,
+        "mongo_ops_per_event": (mongo.operations - mongo_before) / len(acks),
+        "slack_calls_per_event": (slack.total() - slack_before) / len(acks),
+        "handlers": {name: (percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000, len(values))
+            for name, values in sorted(latencies.items())}
+    }
+
+def report(label, result):
+    print(f"\n== {label}")
+    print(f"{result['events']} events, {result['events_per_second']:.1f} events/s, "
+        f"ack p50 {result['ack_p50_ms']:.2f} ms, p99 {result['ack_p99_ms']:.2f} ms, "
+        f"{result['mongo_ops_per_event']:.2f} Mongo ops/event, {result['slack_calls_per_event']:.2f} Slack calls/event")
+    print(f"{'handler':<24}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, (p50, p99, count) in result["handlers"].items():
+        print(f"{name:<24}{count:>8}{p50:>10.2f}{p99:>10.2f}")
+
+# Stores `count` referenda that have already expired and closes them all.
+def close_referenda(app, slack, mongo, channel, count):
+    expired = datetime.utcnow() - timedelta(seconds=app.REFERENDUM_EXPIRATION_SECONDS + 60)
+    for i in range(count):
+        ts = f"{expired.timestamp() + i:.6f}"
+        app.referendum_data.store_referendum({
+            "spot_ts": ts,
+            "vote_ts": ts,
+            "channel_id": channel,
+            "team_id": TEAM_ID,
+            "loc_id": app.unique_location_identifier({"channel": channel}, {"team_id": TEAM_ID}),
+            "date": expired
+        })
+    mongo_before, slack_before = mongo.operations, slack.total()
+    start = time.perf_counter()
+    app.scheduler.close_expired()
+    closed = time.perf_counter() - start
+    # The verdicts are queued replies
+    wait_until_idle(app)
+    drained = time.perf_counter() - start
+    print(f"\n== closing {count} expired referenda")
+    print(f"closed in {closed:.2f} s ({count / closed:.1f} referenda/s), replies sent after {drained:.2f} s, "
+        f"{(mongo.operations - mongo_before) / count:.2f} Mongo ops/referendum, {(slack.total() - slack_before) / count:.2f} Slack calls/referendum")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo-uri", help="Benchmark against this mongod instead of mongomock.")
+    parser.add_argument("--sizes", default="10:0,100:1000,1000:10000",
+        help="Comma-separated channel sizes as members:existing_chums.")
+    parser.add_argument("--events", type=int, default=500, help="Events per channel size.")
+    parser.add_argument("--slack-latency-ms", type=float, default=0, help="Delay added to each fake Slack call.")
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the outbox's Slack rate limits and the per-workspace command quota.")
+    parser.add_argument("--referenda", type=int, default=200, help="Expired referenda to close after the events.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="Write the generated events to this JSON-lines file.")
+    parser.add_argument("--replay", help="Replay events from this JSON-lines file instead.")
+    args = parser.parse_args()
+
+    slack = FakeSlack(args.slack_latency_ms / 1000)
+    mongo = MongoCounter()
+    app = measure_startup(args, slack, mongo)
+    install(app)
+    client = app.app.test_client()
+    latencies = defaultdict(list)
+    time_handlers(app, latencies)
+
+    if args.replay:
+        with open(args.replay) as file:
+            events = [(record["kind"], record["event"]) for record in map(json.loads, file)]
+        report(f"replay of {args.replay}", run(app, client, slack, mongo, events, latencies))
+        return
+
+    record = open(args.record, "w") if args.record else None
+    for index, size in enumerate(args.sizes.split(",")):
+        members, history = (int(part) for part in size.split(":"))
+        channel = f"CBENCH{index}"
+        seed_history(app, channel, members, history, args.seed)
+        events = list(generate_events(channel, members, args.events, args.seed))
+        if record:
+            for kind, event in events:
+                record.write(json.dumps({"kind": kind, "event": event}) + "\n")
+        report(f"{members} members, {history} existing chums", run(app, client, slack, mongo, events, latencies))
+    if record:
+        record.close()
+    if args.referenda:
+        close_referenda(app, slack, mongo, "CBENCHREFERENDA", args.referenda)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import threading, time
+
+
+# Bounded least-recently-used cache whose entries also expire after a fixed
+# number of seconds. Safe to share between listener threads.
+class TTLCache():
+    def __init__(self, maxsize, ttl_seconds):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Called with the stat counted, or None, and the number of entries
+        # whenever either changes
+        self.on_change = None
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                    self.count("evictions")
+                self.count("misses")
+                return default
+            self.entries.move_to_end(key)
+            self.count("hits")
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.count("evictions")
+            self.count(None)
+
+    # Results that are None are not cached so lookups that failed are retried.
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = loader()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.count(None)
+
+    def invalidate_where(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+            self.count(None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.count(None)
+
+    # Called with the lock held
+    def count(self, stat):
+        if stat:
+            setattr(self, stat, getattr(self, stat) + 1)
+        if self.on_change:
+            self.on_change(stat, len(self.entries))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
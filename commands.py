@@ -0,0 +1,65 @@
+from collections import namedtuple
+import re
+
+CHUM_WORDS = ["chum", "chummed", "chumming", "chums"]
+
+CHUM = "chum"
+SCOREBOARD = "scoreboard"
+PICS = "pics"
+REFERENDUM = "referendum"
+RESET = "reset"
+CHUMS = "chums"
+RIVALS = "rivals"
+
+# Keyword -> command. Substring keywords match anywhere inside a word, the
+# others only match whole words.
+WORD_COMMANDS = dict(
+    [(word, CHUM) for word in CHUM_WORDS] +
+    [("pics", PICS), ("photos", PICS), ("rivals", RIVALS), ("referendum", REFERENDUM), ("reset", RESET)]
+)
+SUBSTRING_COMMANDS = {"scoreboard": SCOREBOARD, "chumboard": SCOREBOARD}
+# When a message has several keywords, the earliest command in this list wins.
+PRECEDENCE = [CHUM, SCOREBOARD, PICS, CHUMS, RIVALS, REFERENDUM, RESET]
+# Words common in conversation, which are only commands when the message
+# mentions someone or starts with them
+CONVERSATIONAL_COMMANDS = {CHUMS, RIVALS}
+
+TOKEN_PATTERN = re.compile(r"(?P<day>\d{4}-\d{2}-\d{2})|<@(?P<mention>[a-zA-Z0-9]+)>|(?P<word>\w+)")
+
+# name: one of the commands above
+# mentions: mentioned user IDs in order, without duplicates
+# args: lowercased words and dates after the command's keyword
+Command = namedtuple("Command", ["name", "mentions", "args"])
+
+
+# Tokenizes the text once, picking out the command, mentions and arguments.
+# Chum words only log a chum when files are attached; without them "chums"
+# asks for someone's chum graph. Returns None for the (common) messages that
+# are not commands, e.g. "we were chums in college".
+def classify(text, has_files=False):
+    mentions = []
+    words = []
+    found = {}
+    for token in TOKEN_PATTERN.finditer(text or ""):
+        if token.group("mention"):
+            if token.group("mention") not in mentions:
+                mentions.append(token.group("mention"))
+            continue
+        word = (token.group("day") or token.group("word")).lower()
+        name = WORD_COMMANDS.get(word) or next((command for keyword, command in SUBSTRING_COMMANDS.items() if keyword in word), None)
+        if name == CHUM and not has_files:
+            name = CHUMS if word == "chums" else None
+        if name and name not in found:
+            found[name] = len(words) + 1
+        words.append(word)
+
+    for name in PRECEDENCE:
+        if name in CONVERSATIONAL_COMMANDS and not mentions and found.get(name) != 1:
+            continue
+        if name in found:
+            return Command(name, mentions, words[found[name]:])
+    return None
+
+# The users a chum counts for: everyone mentioned except its author and the bot.
+def spotted_users(mentions, spotter, bot_user):
+    return [spotted for spotted in mentions if spotted not in (spotter, bot_user)]
@@ -0,0 +1,12 @@
+# With --preload the app is imported once, before forking, and each worker
+# starts its own background threads.
+def post_fork(server, worker):
+    import app
+    app.start_services()
+
+# Drops a dead worker's live gauges from the combined metrics
+def child_exit(server, worker):
+    import os
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,128 @@
+from pymongo import ASCENDING, DESCENDING
+from bson.son import SON
+from utils import *
+import logging, pymongo.errors
+
+logger = logging.getLogger(__name__)
+
+# Server error code for an index that exists with other options, e.g. a changed TTL
+INDEX_OPTIONS_CONFLICT = 85
+# Returned by servers before 5.0 for a collection that is already sharded
+ALREADY_INITIALIZED = 23
+
+
+# (database, collection, keys, options) for every index the queries rely on.
+# TTL lengths come from the app's settings.
+def index_specs(oauth_state_seconds, processed_event_seconds, referendum_retention_seconds):
+    return [
+        (CONFIG_DATABASE_NAME, INSTALL_COLLECTION_NAME, [("team_id", ASCENDING), ("installed_at", DESCENDING)], {}),
+        (CONFIG_DATABASE_NAME, BOT_COLLECTION_NAME, [("team_id", ASCENDING), ("installed_at", DESCENDING)], {}),
+        (CONFIG_DATABASE_NAME, STATE_COLLECTION_NAME, [("data", ASCENDING)], {"unique": True}),
+        (CONFIG_DATABASE_NAME, STATE_COLLECTION_NAME, [("date", ASCENDING)], {"expireAfterSeconds": oauth_state_seconds}),
+
+        (MAIN_DATABASE_NAME, MAIN_COLLECTION_NAME, [("loc_id", ASCENDING)], {}),
+        (MAIN_DATABASE_NAME, CHUM_COLLECTION_NAME, [("loc_id", ASCENDING), ("mid", ASCENDING)], {"unique": True}),
+        # Exports stream a channel's chums in order
+        (MAIN_DATABASE_NAME, CHUM_COLLECTION_NAME, [("loc_id", ASCENDING), ("ts", ASCENDING)], {}),
+        (MAIN_DATABASE_NAME, COUNTER_COLLECTION_NAME, [("loc_id", ASCENDING), ("user", ASCENDING)], {"unique": True}),
+        # Serves the chumboard: the top N spotters are the first N index entries.
+        (MAIN_DATABASE_NAME, COUNTER_COLLECTION_NAME, [("loc_id", ASCENDING), (SPOT, DESCENDING), ("user", ASCENDING)], {}),
+        (MAIN_DATABASE_NAME, IMAGE_COLLECTION_NAME, [("loc_id", ASCENDING), ("user", ASCENDING), ("ts", ASCENDING), ("index", ASCENDING)], {}),
+        (MAIN_DATABASE_NAME, IMAGE_COLLECTION_NAME, [("loc_id", ASCENDING), ("mid", ASCENDING)], {}),
+        (MAIN_DATABASE_NAME, ROLLUP_COLLECTION_NAME, [("loc_id", ASCENDING), ("day", ASCENDING), ("user", ASCENDING)], {"unique": True}),
+        # One edge per (spotter, spotted) pair, readable from either end or by count
+        (MAIN_DATABASE_NAME, EDGE_COLLECTION_NAME, [("loc_id", ASCENDING), ("spotter", ASCENDING), ("spotted", ASCENDING)], {"unique": True}),
+        (MAIN_DATABASE_NAME, EDGE_COLLECTION_NAME, [("loc_id", ASCENDING), ("spotter", ASCENDING), ("count", DESCENDING)], {}),
+        (MAIN_DATABASE_NAME, EDGE_COLLECTION_NAME, [("loc_id", ASCENDING), ("spotted", ASCENDING), ("count", DESCENDING)], {}),
+        (MAIN_DATABASE_NAME, EDGE_COLLECTION_NAME, [("loc_id", ASCENDING), ("count", DESCENDING)], {}),
+        (MAIN_DATABASE_NAME, REFERENDUM_COLLECTION_NAME, [("date", ASCENDING), ("lease_until", ASCENDING)], {}),
+        (MAIN_DATABASE_NAME, REFERENDUM_COLLECTION_NAME, [("team_id", ASCENDING)], {}),
+        # Referenda are deleted once closed. This only clears out ones that never could be.
+        (MAIN_DATABASE_NAME, REFERENDUM_COLLECTION_NAME, [("date", ASCENDING)], {"expireAfterSeconds": referendum_retention_seconds}),
+        (MAIN_DATABASE_NAME, PROCESSED_EVENT_COLLECTION_NAME, [("date", ASCENDING)], {"expireAfterSeconds": processed_event_seconds}),
+        (MAIN_DATABASE_NAME, TENANT_COLLECTION_NAME, [("team_id", ASCENDING)], {"unique": True}),
+        (MAIN_DATABASE_NAME, TENANT_COLLECTION_NAME, [("chums", DESCENDING)], {}),
+    ]
+
+# Creates missing indexes and updates the length of existing TTL indexes.
+def ensure_indexes(client, oauth_state_seconds, processed_event_seconds, referendum_retention_seconds):
+    for database, collection, keys, options in index_specs(oauth_state_seconds, processed_event_seconds, referendum_retention_seconds):
+        db = client.get_database(database)
+        try:
+            db.get_collection(collection).create_index(keys, **options)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT or "expireAfterSeconds" not in options:
+                raise
+            db.command("collMod", collection, index={"keyPattern": dict(keys), "expireAfterSeconds": options["expireAfterSeconds"]})
+
+
+# (database, collection, filter, sort) of the queries run on every event or
+# poll, with placeholder values. None of them may scan a whole collection.
+HOT_QUERIES = [
+    (CONFIG_DATABASE_NAME, INSTALL_COLLECTION_NAME, {"team_id": "T", "is_enterprise_install": False}, [("installed_at", DESCENDING)]),
+    (CONFIG_DATABASE_NAME, BOT_COLLECTION_NAME, {"team_id": "T", "is_enterprise_install": False}, [("installed_at", DESCENDING)]),
+    (CONFIG_DATABASE_NAME, STATE_COLLECTION_NAME, {"data": "state"}, None),
+    (MAIN_DATABASE_NAME, MAIN_COLLECTION_NAME, {"loc_id": "L"}, None),
+    (MAIN_DATABASE_NAME, CHUM_COLLECTION_NAME, {"loc_id": "L", "mid": "M"}, None),
+    (MAIN_DATABASE_NAME, COUNTER_COLLECTION_NAME, {"loc_id": "L", SPOT: {"$exists": True}}, [(SPOT, DESCENDING), ("user", ASCENDING)]),
+    (MAIN_DATABASE_NAME, IMAGE_COLLECTION_NAME, {"loc_id": "L", "user": "U"}, [("ts", ASCENDING), ("index", ASCENDING)]),
+    (MAIN_DATABASE_NAME, ROLLUP_COLLECTION_NAME, {"loc_id": "L", "day": {"$gte": "2023-01-01", "$lte": "2023-01-31"}}, None),
+    (MAIN_DATABASE_NAME, EDGE_COLLECTION_NAME, {"loc_id": "L", "spotter": "U"}, [("count", DESCENDING)]),
+    (MAIN_DATABASE_NAME, EDGE_COLLECTION_NAME, {"loc_id": "L", "spotted": "U"}, [("count", DESCENDING)]),
+    (MAIN_DATABASE_NAME, EDGE_COLLECTION_NAME, {"loc_id": "L"}, [("count", DESCENDING)]),
+    (MAIN_DATABASE_NAME, TENANT_COLLECTION_NAME, {"team_id": "T"}, None),
+    (MAIN_DATABASE_NAME, REFERENDUM_COLLECTION_NAME, {"date": {"$lt": datetime(2000, 1, 1)}, "$or": [{"lease_until": None}, {"lease_until": {"$lt": datetime(2000, 1, 1)}}]}, [("date", ASCENDING)]),
+]
+
+# Stages of a winning plan, including each shard's on a sharded cluster
+def stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                yield from stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from stages(value)
+
+# Raises if the server would answer a hot query by scanning a collection,
+# e.g. because an index was dropped or a query changed shape.
+def check_query_plans(client):
+    for database, collection, filter, sort in HOT_QUERIES:
+        find = SON([("find", collection), ("filter", filter), ("limit", 1)])
+        if sort:
+            find["sort"] = SON(sort)
+        try:
+            plan = client.get_database(database).command(SON([("explain", find), ("verbosity", "queryPlanner")]))
+        except NotImplementedError:
+            logger.warning("Query plans cannot be checked on this server")
+            return
+        if "COLLSCAN" in stages(plan["queryPlanner"]["winningPlan"]):
+            raise RuntimeError(f"{database}.{collection} query {filter} would scan the whole collection")
+
+
+# Shard key of each collection that grows with the number of workspaces. Each
+# starts with the team-prefixed location id (or the team id), so a workspace's
+# documents are kept together and can be pinned to shards with zones. Each is
+# also the prefix of the collection's unique indexes, as sharding requires.
+SHARD_KEYS = {
+    MAIN_COLLECTION_NAME: [("loc_id", ASCENDING)],
+    CHUM_COLLECTION_NAME: [("loc_id", ASCENDING), ("mid", ASCENDING)],
+    COUNTER_COLLECTION_NAME: [("loc_id", ASCENDING), ("user", ASCENDING)],
+    IMAGE_COLLECTION_NAME: [("loc_id", ASCENDING), ("mid", ASCENDING)],
+    ROLLUP_COLLECTION_NAME: [("loc_id", ASCENDING), ("day", ASCENDING), ("user", ASCENDING)],
+    EDGE_COLLECTION_NAME: [("loc_id", ASCENDING), ("spotter", ASCENDING), ("spotted", ASCENDING)],
+    TENANT_COLLECTION_NAME: [("team_id", ASCENDING)],
+}
+
+# Shards the main database's growing collections. Needs a mongos, and the
+# indexes to exist.
+def shard_collections(client):
+    client.admin.command("enableSharding", MAIN_DATABASE_NAME)
+    for collection, key in SHARD_KEYS.items():
+        try:
+            client.admin.command("shardCollection", f"{MAIN_DATABASE_NAME}.{collection}", key=SON(key))
+        except pymongo.errors.OperationFailure as e:
+            if e.code != ALREADY_INITIALIZED:
+                raise
@@ -0,0 +1,62 @@
+from logging.handlers import QueueHandler, QueueListener
+from metrics import LOGS_DROPPED
+import logging, os, queue, random, sys
+
+LOG_QUEUE_SIZE = 10000
+# Share of routine per-call records (cache misses, store lookups) that get logged
+LOG_SAMPLE_RATE = float(os.environ.get("SPOTBOT_LOG_SAMPLE_RATE", 0.01))
+
+
+# extra= for a record with key=value fields, kept only sample_rate of the time.
+def fields(sample_rate=1, **values):
+    return {"fields": values, "sample_rate": sample_rate}
+
+def sampled(**values):
+    return fields(sample_rate=LOG_SAMPLE_RATE, **values)
+
+
+# Appends the record's fields to the message as key=value pairs.
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        values = getattr(record, "fields", None)
+        if values:
+            message += " " + " ".join(f"{key}={value!r}" for key, value in values.items())
+        return message
+
+class SampleFilter(logging.Filter):
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", 1)
+        return rate >= 1 or random.random() < rate
+
+# Drops records instead of blocking the logging thread when the writer falls behind.
+class DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOGS_DROPPED.inc()
+
+
+# Moves the root logger's handlers (from logging.ini under gunicorn, or stdout
+# otherwise) behind a bounded queue written by a background thread, so
+# listeners never wait on stdout.
+def enable_queue_logging():
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if not handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(KeyValueFormatter("[%(asctime)s] [%(process)d] [%(levelname)s] - %(module)s - %(message)s"))
+        handlers = [handler]
+        root.setLevel(logging.INFO)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SampleFilter())
+    root.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Threads do not survive a fork, so forked workers need their own writer
+    os.register_at_fork(after_in_child=listener.start)
+    return listener
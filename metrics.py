@@ -0,0 +1,119 @@
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from pymongo import monitoring
+import bson, functools, os, random, threading, time
+
+# Share of listener calls whose Mongo bytes are measured, as that means
+# encoding every command and reply again
+MONGO_BYTES_SAMPLE_RATE = float(os.environ.get("SPOTBOT_MONGO_BYTES_SAMPLE_RATE", 0.01))
+
+LISTENER_SECONDS = Histogram("spotbot_listener_seconds", "Time spent in each listener", ["listener"])
+LISTENER_ERRORS = Counter("spotbot_listener_errors_total", "Listeners that raised", ["listener"])
+MONGO_COMMANDS = Counter("spotbot_mongo_commands_total", "Mongo commands sent", ["command"])
+MONGO_SECONDS = Histogram("spotbot_mongo_command_seconds", "Mongo command round trip time", ["command"])
+MONGO_FAILURES = Counter("spotbot_mongo_command_failures_total", "Mongo commands that failed", ["command"])
+MONGO_ROUND_TRIPS_PER_EVENT = Histogram("spotbot_mongo_round_trips_per_event", "Mongo commands sent by one listener call",
+    ["listener"], buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128))
+MONGO_BYTES_PER_EVENT = Histogram("spotbot_mongo_bytes_per_event", "Mongo bytes sent and received by a sample of listener calls",
+    ["listener"], buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+SLACK_CALLS = Counter("spotbot_slack_calls_total", "Slack Web API calls", ["method", "outcome"])
+SLACK_SECONDS = Histogram("spotbot_slack_call_seconds", "Slack Web API call latency", ["method"])
+REFERENDUM_LAG_SECONDS = Histogram("spotbot_referendum_lag_seconds", "How long after expiring a referendum was closed",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 900, 3600))
+REFERENDA_CLOSED = Counter("spotbot_referenda_closed_total", "Expired referenda processed", ["outcome"])
+REFERENDUM_BATCH_SECONDS = Histogram("spotbot_referendum_batch_seconds", "Time spent closing one batch of expired referenda",
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120))
+QUOTA_REJECTIONS = Counter("spotbot_quota_rejections_total", "Commands refused because their workspace was over a quota", ["quota"])
+LOGS_DROPPED = Counter("spotbot_logs_dropped_total", "Log records dropped because the log queue was full")
+CACHE_STATS = {stat: Counter(f"spotbot_cache_{stat}", f"Cache {stat}", ["cache"]) for stat in ("hits", "misses", "evictions")}
+CACHE_ENTRIES = Gauge("spotbot_cache_entries", "Entries in each cache", ["cache"], multiprocess_mode="livesum")
+
+# [commands, bytes, whether bytes are measured] sent and received by the
+# current thread's listener
+usage = threading.local()
+
+
+def record_usage(commands, size):
+    counts = getattr(usage, "counts", None)
+    if counts is not None:
+        counts[0] += commands
+        counts[1] += size
+
+def measuring_bytes():
+    counts = getattr(usage, "counts", None)
+    return counts is not None and counts[2]
+
+# Records latency, errors and Mongo usage of each call under the function's
+# name. A timed function called from another one adds its usage to the
+# caller's. Bytes are measured for a sample of the outermost calls.
+def timed(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        outer = getattr(usage, "counts", None)
+        measure = outer[2] if outer is not None else random.random() < MONGO_BYTES_SAMPLE_RATE
+        counts = usage.counts = [0, 0, measure]
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            LISTENER_ERRORS.labels(function.__name__).inc()
+            raise
+        finally:
+            LISTENER_SECONDS.labels(function.__name__).observe(time.perf_counter() - start)
+            MONGO_ROUND_TRIPS_PER_EVENT.labels(function.__name__).observe(counts[0])
+            if measure:
+                MONGO_BYTES_PER_EVENT.labels(function.__name__).observe(counts[1])
+            usage.counts = outer
+            record_usage(counts[0], counts[1])
+    return wrapper
+
+
+# Pymongo calls these on the thread that issued the command.
+class MongoMetrics(monitoring.CommandListener):
+    def started(self, event):
+        MONGO_COMMANDS.labels(event.command_name).inc()
+        record_usage(1, len(bson.encode(event.command)) if measuring_bytes() else 0)
+
+    def succeeded(self, event):
+        MONGO_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        if measuring_bytes():
+            record_usage(0, len(bson.encode(event.reply)))
+
+    def failed(self, event):
+        MONGO_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(event.command_name).inc()
+
+
+# Counts a cache's hits, misses and evictions as they happen, so they are
+# added up across workers like the other counters.
+def watch_cache(name, cache):
+    stats = {stat: counter.labels(name) for stat, counter in CACHE_STATS.items()}
+    entries = CACHE_ENTRIES.labels(name)
+
+    def on_change(stat, size):
+        if stat:
+            stats[stat].inc()
+        entries.set(size)
+    cache.on_change = on_change
+
+# Reports a queue's depth. The component calls on_change whenever it queues
+# or takes work, so the gauge is written as it changes and, like the other
+# metrics, added up across workers.
+def watch_depth(name, component):
+    gauge = Gauge(f"spotbot_{name}_depth", f"Items waiting in the {name}", multiprocess_mode="livesum")
+    lock = threading.Lock()
+
+    def on_change():
+        # Read and written together, so the last change is the one reported
+        with lock:
+            gauge.set(component.depth())
+    component.on_change = on_change
+
+# Under gunicorn set PROMETHEUS_MULTIPROC_DIR so every worker's counters are
+# added up, whichever worker answers the scrape.
+def render():
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), 200, {"Content-Type": CONTENT_TYPE_LATEST}
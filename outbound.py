@@ -0,0 +1,196 @@
+from collections import Counter, OrderedDict
+from slack_sdk.errors import SlackApiError
+from metrics import SLACK_CALLS, SLACK_SECONDS
+from logs import fields
+import logging, threading, time, zlib
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute allowed for each Web API method, per workspace.
+# https://api.slack.com/docs/rate-limits
+METHOD_LIMITS_PER_MINUTE = {
+    "auth_test": 100,
+    "chat_postMessage": 60,
+    "conversations_history": 50,
+    "conversations_replies": 50,
+    "files_upload_v2": 20,
+    "reactions_add": 50,
+    "reactions_get": 50,
+    "reactions_remove": 20,
+    "users_conversations": 50,
+    "users_profile_get": 100,
+}
+DEFAULT_LIMIT_PER_MINUTE = 20
+BURST_SECONDS = 10
+# Errors that mean the reaction is already in the state we wanted
+SETTLED_ERRORS = {"already_reacted", "no_reaction"}
+REACTION_METHODS = {"reactions_add", "reactions_remove"}
+
+
+def retry_after(response):
+    headers = {name.lower(): value for name, value in response.headers.items()}
+    return int(headers.get("retry-after", 1))
+
+
+class TokenBucket():
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = max(1, per_minute * BURST_SECONDS / 60)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    # Takes a token, returning how long the caller must wait before using it.
+    def reserve(self):
+        with self.lock:
+            now = self.refill()
+            self.tokens -= 1
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.blocked_until - now)
+
+    # Takes a token if one is available now, without waiting or going into debt.
+    def try_take(self):
+        with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    # Slack told us to back off (429 with Retry-After)
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+# Sends Web API calls within each workspace's per-method rate limits, retrying
+# rate limited and failed calls with backoff. Calls whose result is not needed
+# are queued with post(); queued reaction changes to the same message collapse
+# into the last one, e.g. the remove + add of an edited chum.
+class SlackOutbox():
+    def __init__(self, workers, queue_size, max_retries=3):
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.buckets = {}
+        self.buckets_lock = threading.Lock()
+        self.shards = [(OrderedDict(), threading.Condition()) for _ in range(workers)]
+        self.calls = Counter()
+        self.retries = Counter()
+        self.failures = Counter()
+        self.coalesced = 0
+        self.stopped = False
+        self.threads = []
+        # Called after a call is queued or taken
+        self.on_change = None
+
+    # call() works without starting; post() queues until the workers start.
+    def start(self):
+        self.threads = [threading.Thread(target=self.work, args=shard, daemon=True) for shard in self.shards]
+        for thread in self.threads:
+            thread.start()
+
+    def bucket(self, token, method):
+        with self.buckets_lock:
+            key = (token, method)
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(METHOD_LIMITS_PER_MINUTE.get(method, DEFAULT_LIMIT_PER_MINUTE))
+            return self.buckets[key]
+
+    # Each bot token belongs to one workspace, so limits are tracked per token.
+    def call(self, client, method, **kwargs):
+        bucket = self.bucket(kwargs.get("token") or client.token, method)
+        for attempt in range(self.max_retries + 1):
+            time.sleep(bucket.reserve())
+            self.calls[method] += 1
+            start = time.perf_counter()
+            try:
+                response = getattr(client, method)(**kwargs)
+                SLACK_CALLS.labels(method, "ok").inc()
+                return response
+            except SlackApiError as e:
+                SLACK_CALLS.labels(method, e.response.status_code).inc()
+                rate_limited = e.response.status_code == 429
+                if attempt == self.max_retries or not (rate_limited or e.response.status_code >= 500):
+                    raise
+                self.retries[method] += 1
+                if rate_limited:
+                    bucket.block(retry_after(e.response))
+                    continue
+            except OSError:
+                SLACK_CALLS.labels(method, "connection_error").inc()
+                if attempt == self.max_retries:
+                    raise
+                self.retries[method] += 1
+            finally:
+                SLACK_SECONDS.labels(method).observe(time.perf_counter() - start)
+            time.sleep(2 ** attempt)
+
+    def post(self, client, method, **kwargs):
+        token = kwargs.get("token") or client.token
+        if method in REACTION_METHODS:
+            key = ("reaction", token, kwargs["channel"], kwargs["timestamp"], kwargs["name"])
+        else:
+            key = object()
+
+        pending, condition = self.shards[zlib.crc32((token or "").encode("utf-8")) % len(self.shards)]
+        with condition:
+            while len(pending) >= self.queue_size and key not in pending:
+                condition.wait()
+            if key in pending:
+                # Keep the queue position but only send the latest change
+                self.coalesced += 1
+            pending[key] = (client, method, kwargs)
+            condition.notify_all()
+        self.changed()
+
+    def depth(self):
+        return sum(len(pending) for pending, _ in self.shards)
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "calls": dict(self.calls),
+            "retries": dict(self.retries),
+            "failures": dict(self.failures),
+            "coalesced": self.coalesced
+        }
+
+    # Sends everything already queued, then stops the workers.
+    def shutdown(self):
+        self.stopped = True
+        for _, condition in self.shards:
+            with condition:
+                condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def work(self, pending, condition):
+        while True:
+            with condition:
+                while not pending and not self.stopped:
+                    condition.wait()
+                if not pending:
+                    return
+                _, (client, method, kwargs) = pending.popitem(last=False)
+                condition.notify_all()
+            self.changed()
+            try:
+                self.call(client, method, **kwargs)
+            except SlackApiError as e:
+                if e.response.get("error") not in SETTLED_ERRORS:
+                    self.failures[method] += 1
+                    logger.warning("Slack rejected a call", extra=fields(method=method, error=e.response.get("error")))
+            except Exception:
+                self.failures[method] += 1
+                logger.exception("Encountered an exception while calling Slack", extra=fields(method=method))
@@ -0,0 +1,75 @@
+from logs import fields
+import functools, logging, queue, threading, zlib
+
+logger = logging.getLogger(__name__)
+
+
+# Runs submitted work on a fixed set of worker threads, each with a bounded
+# queue. Work submitted with the same key always goes to the same worker, so
+# events in one channel are processed in the order they arrived. Work can be
+# queued before start(), and runs once the workers are started.
+class ChannelOrderedExecutor():
+    def __init__(self, workers, queue_size, put_timeout_seconds):
+        self.put_timeout_seconds = put_timeout_seconds
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        # Called after work is queued or taken
+        self.on_change = None
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.work, args=(q,), daemon=True) for q in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def queue_for(self, key):
+        return self.queues[zlib.crc32(key.encode("utf-8")) % len(self.queues)]
+
+    # Raises queue.Full if the key's worker is still backed up after the timeout.
+    def submit(self, key, function, *args, **kwargs):
+        self.queue_for(key).put((function, args, kwargs), timeout=self.put_timeout_seconds)
+        self.changed()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def join(self):
+        for q in self.queues:
+            q.join()
+
+    def shutdown(self):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def work(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            self.changed()
+            function, args, kwargs = item
+            try:
+                function(*args, **kwargs)
+            except Exception:
+                logger.exception("Encountered an exception while processing an event", extra=fields(function=function.__name__))
+            finally:
+                q.task_done()
+
+def channel_key(event, body):
+    return f"{body.get('team_id')}:{event.get('channel')}"
+
+# Turns a Bolt listener into one that only enqueues its work, keyed by channel.
+# functools.wraps keeps the argument names Bolt uses to inject event, say, etc.
+def in_channel_order(executor):
+    def decorator(listener):
+        @functools.wraps(listener)
+        def submit(**kwargs):
+            executor.submit(channel_key(kwargs["event"], kwargs["body"]), listener, **kwargs)
+        return submit
+    return decorator
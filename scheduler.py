@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from metrics import REFERENDUM_LAG_SECONDS, REFERENDA_CLOSED, REFERENDUM_BATCH_SECONDS
+from logs import fields
+import logging, os, socket, threading, time, uuid
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "referendum-scheduler"
+
+
+# Closes expired referenda from whichever process holds the scheduler lease.
+# The leader sleeps until the next referendum expires (or until the lease
+# needs renewing); the others only check whether the lease is free.
+#
+# Expired referenda are claimed in batches of batch_size and grouped by team:
+# resolve(team_id) runs once per team, then process(referendum, resolved)
+# runs for each referendum on a pool of worker threads. Slack's rate limits
+# can stretch a batch past lease_seconds, so both the scheduler lease and the
+# batch's leases are renewed on a heartbeat until it is done.
+class ReferendumScheduler():
+    def __init__(self, referenda, leases, resolve, process, lease_seconds, batch_size=50, workers=8):
+        self.referenda = referenda
+        self.leases = leases
+        self.resolve = resolve
+        self.process = process
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.pool = None
+
+    def start(self):
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="referendum")
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+        if self.pool:
+            self.pool.shutdown()
+        self.leases.release(LEASE_NAME, self.owner)
+
+    def run(self):
+        while not self.stopped:
+            # Renew well before the lease runs out
+            timeout = self.lease_seconds / 3
+            try:
+                if self.leases.acquire(LEASE_NAME, self.owner, self.lease_seconds):
+                    self.close_expired()
+                    next_expiration = self.referenda.next_expiration()
+                    if next_expiration:
+                        timeout = min(timeout, max(0, (next_expiration - datetime.utcnow()).total_seconds()))
+            except Exception:
+                logger.exception("Encountered an exception while scheduling referenda")
+            self.wake.wait(timeout)
+            self.wake.clear()
+
+    def close_expired(self):
+        # A backlog can take several batches, so the lease is renewed between them
+        while not self.stopped and self.leases.acquire(LEASE_NAME, self.owner, self.lease_seconds):
+            batch = self.referenda.claim_expired(self.owner, self.lease_seconds, self.batch_size)
+            if not batch:
+                return
+            start = time.perf_counter()
+            done = threading.Event()
+            heartbeat = threading.Thread(target=self.heartbeat, args=(batch, done), daemon=True)
+            heartbeat.start()
+            try:
+                closed = self.close_batch(batch)
+            finally:
+                done.set()
+                heartbeat.join()
+            self.referenda.complete(closed)
+            seconds = time.perf_counter() - start
+            REFERENDUM_BATCH_SECONDS.observe(seconds)
+            logger.info("Closed expired referenda", extra=fields(claimed=len(batch), closed=len(closed), seconds=round(seconds, 3)))
+
+    def heartbeat(self, batch, done):
+        while not done.wait(self.lease_seconds / 3):
+            try:
+                if self.leases.acquire(LEASE_NAME, self.owner, self.lease_seconds):
+                    self.referenda.renew(batch, self.lease_seconds)
+            except Exception:
+                logger.exception("Encountered an exception while renewing referendum leases")
+
+    # Returns the referenda that were closed; failed ones stay leased and are
+    # retried once their lease runs out.
+    def close_batch(self, batch):
+        teams = {}
+        for referendum in batch:
+            teams.setdefault(referendum["team_id"], []).append(referendum)
+
+        futures = []
+        for team_id, referenda in teams.items():
+            try:
+                resolved = self.resolve(team_id)
+            except Exception:
+                logger.exception("Encountered an exception while processing expired referenda", extra=fields(team_id=team_id))
+                REFERENDA_CLOSED.labels("failed").inc(len(referenda))
+                continue
+            futures.extend((referendum, self.pool.submit(self.close, referendum, resolved)) for referendum in referenda)
+        return [referendum for referendum, future in futures if future.result()]
+
+    def close(self, referendum, resolved):
+        expired = referendum["date"] + timedelta(seconds=self.referenda.expiration_seconds)
+        REFERENDUM_LAG_SECONDS.observe((datetime.utcnow() - expired).total_seconds())
+        try:
+            self.process(referendum, resolved)
+        except Exception:
+            logger.exception("Encountered an exception while processing expired referenda", extra=fields(team_id=referendum["team_id"]))
+            REFERENDA_CLOSED.labels("failed").inc()
+            return False
+        REFERENDA_CLOSED.labels("closed").inc()
+        return True
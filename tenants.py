@@ -0,0 +1,53 @@
+from outbound import TokenBucket
+from metrics import QUOTA_REJECTIONS
+from logs import sampled
+import logging, threading
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PAGE_SIZE = 200
+CHANNEL_TYPES = "public_channel,private_channel,mpim"
+
+
+# Per-workspace limits, so one busy workspace can't take over the event
+# workers or the database. The command rate is enforced per process; 0
+# disables either limit.
+class TenantQuotas():
+    def __init__(self, tenants, commands_per_minute, max_chums):
+        self.tenants = tenants
+        self.commands_per_minute = commands_per_minute
+        self.max_chums = max_chums
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def reject(self, quota, team_id):
+        QUOTA_REJECTIONS.labels(quota).inc()
+        logger.warning("Workspace is over its quota", extra=sampled(quota=quota, team_id=team_id))
+        return False
+
+    def allow_command(self, team_id):
+        if not self.commands_per_minute:
+            return True
+        with self.lock:
+            if team_id not in self.buckets:
+                self.buckets[team_id] = TokenBucket(self.commands_per_minute)
+            bucket = self.buckets[team_id]
+        return bucket.try_take() or self.reject("commands", team_id)
+
+    def allow_chum(self, team_id):
+        if not self.max_chums or self.tenants.get_usage(team_id).get("chums", 0) < self.max_chums:
+            return True
+        return self.reject("chums", team_id)
+
+
+# Yields the ids of the channels the bot is in.
+def member_channels(outbox, client):
+    cursor = None
+    while True:
+        page = outbox.call(client, "users_conversations", types=CHANNEL_TYPES, exclude_archived=False,
+            limit=CHANNEL_PAGE_SIZE, cursor=cursor)
+        for channel in page["channels"]:
+            yield channel["id"]
+        cursor = page.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
@@ -0,0 +1,25 @@
+import os, sys
+import mongomock, pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indexes import ensure_indexes
+from utils import SpotDatabase, unique_location_identifier
+
+TEAM_ID = "T1"
+
+
+def location(channel, team_id=TEAM_ID):
+    return unique_location_identifier({"channel": channel}, {"team_id": team_id})
+
+
+@pytest.fixture
+def client():
+    client = mongomock.MongoClient()
+    ensure_indexes(client, 600, 3600, 86400)
+    return client
+
+
+@pytest.fixture
+def database(client):
+    return SpotDatabase(client)
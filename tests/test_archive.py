@@ -0,0 +1,27 @@
+import gzip
+from archive import export_channel, import_channel
+from conftest import TEAM_ID, location
+
+
+def test_round_trip_imports_repeated_chums_once(database, tmp_path):
+    source, target = location("C1"), location("C2")
+    with database.session_for_loc(source, write_behind=False) as chums:
+        chums.set_manager("U9")
+        for number in range(3):
+            chums.record_chum(f"m{number}", "U1", ["U2"], [f"https://files/{number}.jpg"], f"{1700000000 + number}.000100")
+    path = tmp_path / "channel.jsonl.gz"
+    assert export_channel(database, source, str(path)) == 3
+
+    # The same chum twice, as in an edited export
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        lines = file.readlines()
+    with gzip.open(path, "wt", encoding="utf-8") as file:
+        file.writelines(lines + lines[1:2])
+
+    assert import_channel(database, target, str(path)) == 3
+    chums = database.session_for_loc(target)
+    assert chums.get_manager() == "U9"
+    assert chums.count_chums() == 3
+    assert chums.get_top_spotters(1) == [("U1", 3)]
+    assert chums.count_images("U2") == 3
+    assert database.tenants.find_one({"team_id": TEAM_ID})["chums"] == 6
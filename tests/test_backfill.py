@@ -0,0 +1,144 @@
+import pytest
+import backfill, outbound
+from backfill import backfill_channel
+from conftest import TEAM_ID, location
+from outbound import SlackOutbox
+from utils import REFERENDUM_PROMPT, CHUM_IS_GOOD, CHUM_IS_BAD
+
+BOT_USER = "UBOT"
+CHANNEL = "C1"
+
+
+# Answers conversations.history and conversations.replies from a fixed
+# channel history, like Slack: newest first, paged by cursor, before `latest`.
+class StubSlack():
+    def __init__(self, messages, threads=None, fail_after_pages=None):
+        self.token = "xoxb-test"
+        self.messages = sorted(messages, key=lambda message: float(message["ts"]), reverse=True)
+        self.threads = threads or {}
+        self.fail_after_pages = fail_after_pages
+        self.pages = 0
+
+    def page(self, messages, limit, cursor):
+        start = int(cursor or 0)
+        more = start + limit < len(messages)
+        return {
+            "ok": True,
+            "messages": messages[start:start + limit],
+            "has_more": more,
+            "response_metadata": {"next_cursor": str(start + limit) if more else ""}
+        }
+
+    def conversations_history(self, channel, latest=None, limit=100, cursor=None):
+        if self.fail_after_pages is not None and self.pages >= self.fail_after_pages:
+            raise ConnectionError("lost the connection to Slack")
+        self.pages += 1
+        messages = [message for message in self.messages if latest is None or float(message["ts"]) < float(latest)]
+        return self.page(messages, limit, cursor)
+
+    def conversations_replies(self, channel, ts, limit=100, cursor=None):
+        return self.page(self.threads.get(ts, []), limit, cursor)
+
+
+def chum(number, replies=0):
+    message = {
+        "type": "message",
+        "user": "U1",
+        "ts": f"{1700000000 + number}.000100",
+        "text": "chum <@U2>",
+        "files": [{"url_private": f"https://files/{number}.jpg", "id": f"F{number}"}]
+    }
+    if replies:
+        message["reply_count"] = replies
+    return message
+
+
+def bot_replies(*texts):
+    return [{"user": BOT_USER, "text": text} for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(backfill, "HISTORY_PAGE_SIZE", 3)
+    monkeypatch.setattr(backfill, "BATCH_SIZE", 5)
+    monkeypatch.setattr(outbound, "METHOD_LIMITS_PER_MINUTE", {})
+    monkeypatch.setattr(outbound, "DEFAULT_LIMIT_PER_MINUTE", 10 ** 9)
+
+
+@pytest.fixture
+def outbox():
+    # A lost connection fails the backfill at once instead of being retried
+    return SlackOutbox(1, 10, max_retries=0)
+
+
+def run(database, outbox, client, restart=False):
+    return backfill_channel(database, outbox, client, TEAM_ID, CHANNEL, BOT_USER, restart)
+
+
+def test_reads_every_page(database, outbox):
+    client = StubSlack([chum(number) for number in range(12)] + [{"type": "message", "user": "U1", "ts": "1700000100.000100", "text": "hi"}])
+
+    assert run(database, outbox, client) == 12
+    assert client.pages == 5
+    chums = database.session_for_loc(location(CHANNEL))
+    assert chums.count_chums() == 12
+    assert chums.get_top_spotters(1) == [("U1", 12)]
+    assert chums.count_images("U2") == 12
+    assert database.get_checkpoint(location(CHANNEL)) is None
+
+
+def test_resumes_from_checkpoint_after_crash(database, outbox):
+    messages = [chum(number) for number in range(12)]
+    # The first batch of 5 is committed on the second page
+    with pytest.raises(ConnectionError):
+        run(database, outbox, StubSlack(messages, fail_after_pages=3))
+    assert database.get_checkpoint(location(CHANNEL))["count"] == 5
+
+    client = StubSlack(messages)
+    assert run(database, outbox, client) == 12
+    chums = database.session_for_loc(location(CHANNEL))
+    assert chums.count_chums() == 12
+    assert chums.get_top_spotters(1) == [("U1", 12)]
+    assert database.tenants.find_one({"team_id": TEAM_ID})["chums"] == 12
+
+
+def test_restart_ignores_checkpoint(database, outbox):
+    messages = [chum(number) for number in range(12)]
+    with pytest.raises(ConnectionError):
+        run(database, outbox, StubSlack(messages, fail_after_pages=3))
+
+    assert run(database, outbox, StubSlack(messages), restart=True) == 12
+    assert database.session_for_loc(location(CHANNEL)).get_top_spotters(1) == [("U1", 12)]
+
+
+def test_referenda(database, outbox):
+    rejected, accepted, discussed = chum(1, replies=2), chum(2, replies=2), chum(3, replies=1)
+    client = StubSlack([rejected, accepted, discussed, chum(4)], threads={
+        rejected["ts"]: bot_replies(REFERENDUM_PROMPT, CHUM_IS_BAD),
+        accepted["ts"]: bot_replies(REFERENDUM_PROMPT, CHUM_IS_GOOD),
+        discussed["ts"]: [{"user": "U3", "text": REFERENDUM_PROMPT}]
+    })
+
+    assert run(database, outbox, client) == 3
+    held = {chum["ts"]: chum["referendum"] for chum in database.chums.find({"loc_id": location(CHANNEL)})}
+    assert held == {accepted["ts"]: True, discussed["ts"]: False, chum(4)["ts"]: False}
+
+
+def test_chum_logged_meanwhile_is_kept_once(database, outbox):
+    messages = [chum(number) for number in range(12)]
+    client = StubSlack(messages)
+    history = client.conversations_history
+
+    # A listener logs the newest chum while the first page is read
+    def log_live(**kwargs):
+        if not client.pages:
+            with database.session_for_loc(location(CHANNEL)) as chums:
+                chums.record_chum(*backfill.replay(outbox, client, CHANNEL, messages[-1], BOT_USER))
+        return history(**kwargs)
+    client.conversations_history = log_live
+
+    assert run(database, outbox, client) == 12
+    chums = database.session_for_loc(location(CHANNEL))
+    assert chums.count_chums() == 12
+    assert chums.get_top_spotters(1) == [("U1", 12)]
+    assert database.tenants.find_one({"team_id": TEAM_ID})["chums"] == 12
@@ -0,0 +1,23 @@
+import pytest
+from commands import classify, CHUM, CHUMS, PICS, RIVALS
+
+
+@pytest.mark.parametrize("text", ["we were chums in college", "great rivals today", "those two are rivals, chums even"])
+def test_conversation_is_not_a_command(text):
+    assert classify(text) is None
+
+
+@pytest.mark.parametrize("text, name", [
+    ("chums", CHUMS),
+    ("rivals", RIVALS),
+    ("chums <@U1>", CHUMS),
+    ("who are <@U1>'s rivals", RIVALS),
+    ("pics <@U1> page 2", PICS),
+])
+def test_commands(text, name):
+    assert classify(text).name == name
+
+
+def test_chum_needs_files():
+    assert classify("chum <@U1>", has_files=True) == (CHUM, ["U1"], [])
+    assert classify("chummed <@U1>") is None
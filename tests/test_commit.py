@@ -0,0 +1,45 @@
+import mongomock.collection
+from conftest import TEAM_ID, location
+
+TS = "1700000000.000100"
+
+
+def record(database, spotted):
+    with database.session_for_loc(location("C1")) as chums:
+        chums.record_chum("m1", "U1", spotted, ["https://files/1.jpg"], TS)
+
+
+def edit(database, spotted):
+    with database.session_for_loc(location("C1")) as chums:
+        chums.delete_chum("m1")
+        chums.record_chum("m1", "U1", spotted, ["https://files/1.jpg"], TS)
+
+
+def test_unchanged_counts_not_written_on_edit(database, monkeypatch):
+    record(database, ["U2"])
+    written = []
+    bulk_write = mongomock.collection.Collection.bulk_write
+
+    def counting(collection, requests, **kwargs):
+        written.append(collection.name)
+        return bulk_write(collection, requests, **kwargs)
+    monkeypatch.setattr(mongomock.collection.Collection, "bulk_write", counting)
+
+    edit(database, ["U2"])
+    assert sorted(written) == ["chums", "images", "spot-bot-main"]
+    chums = database.session_for_loc(location("C1"))
+    assert chums.get_top_spotters(1) == [("U1", 1)]
+    assert chums.count_images("U2") == 1
+
+
+def test_edit_moves_counts(database):
+    record(database, ["U2"])
+    edit(database, ["U3", "U4"])
+
+    chums = database.session_for_loc(location("C1"))
+    assert chums.get_top_spotters(1) == [("U1", 2)]
+    caught = {counter["user"]: counter.get("caught") for counter in database.counters.find({"caught": {"$exists": True}})}
+    assert caught == {"U2": 0, "U3": 1, "U4": 1}
+    assert chums.count_images("U2") == 0
+    tenant = database.tenants.find_one({"team_id": TEAM_ID})
+    assert (tenant["chums"], tenant["images"]) == (1, 2)
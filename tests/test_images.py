@@ -0,0 +1,18 @@
+from conftest import location
+
+
+def test_image_pages_match_from_either_end(database):
+    chums = database.session_for_loc(location("C1"), write_behind=False)
+    with chums:
+        for number in range(13):
+            # Two images per chum, so pages split chums
+            chums.record_chum(f"m{number}", "U1", ["U2"], [f"https://files/{number}a.jpg", f"https://files/{number}b.jpg"],
+                f"{1700000000 + number}.000100")
+    urls = [image["url"] for image in chums.get_images("U2")]
+    total = chums.count_images("U2")
+    assert total == 26
+
+    pages = [[image["url"] for image in chums.get_image_page("U2", first, 10, total)] for first in range(0, total, 10)]
+    assert pages == [urls[0:10], urls[10:20], urls[20:26]]
+    assert [image["url"] for image in chums.get_image_page("U2", 17, 4, total)] == urls[17:21]
+    assert chums.get_image_page("U2", 30, 10, total) == []
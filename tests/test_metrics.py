@@ -0,0 +1,87 @@
+import os, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# prometheus_client picks its storage when imported, so each worker is a
+# separate process.
+WORKER = """
+from cache import TTLCache
+from metrics import watch_cache
+cache = TTLCache(1, 60)
+watch_cache("test", cache)
+cache.get("a")
+cache.set("a", 1)
+cache.get("a")
+cache.set("b", 1)
+"""
+
+QUEUE = """
+from metrics import watch_depth
+from pipeline import ChannelOrderedExecutor
+pipeline = ChannelOrderedExecutor(2, 10, 1)
+watch_depth("event_queue", pipeline)
+for channel in ("C1", "C2", "C3"):
+    pipeline.submit(channel, print)
+"""
+
+SCRAPE = """
+from metrics import render
+print(render()[0].decode())
+"""
+
+
+def run(code, environment):
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=environment,
+        check=True, capture_output=True, text=True).stdout
+
+
+def scrape(environment):
+    return dict(line.rsplit(" ", 1) for line in run(SCRAPE, environment).splitlines() if line.startswith("spotbot_"))
+
+
+def test_cache_stats_added_up_across_workers(tmp_path):
+    environment = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    run(WORKER, environment)
+    run(WORKER, environment)
+    samples = scrape(environment)
+
+    assert float(samples['spotbot_cache_hits_total{cache="test"}']) == 2
+    assert float(samples['spotbot_cache_misses_total{cache="test"}']) == 2
+    assert float(samples['spotbot_cache_evictions_total{cache="test"}']) == 2
+
+
+def test_queue_depths_added_up_across_workers(tmp_path):
+    environment = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+    run(QUEUE, environment)
+    run(QUEUE, environment)
+
+    # Both workers have exited, but their gauges stay until marked dead
+    assert float(scrape(environment)["spotbot_event_queue_depth"]) == 6
+
+
+def test_mongo_bytes_measured_for_sampled_calls_only(monkeypatch):
+    import metrics
+    from prometheus_client import REGISTRY
+    from types import SimpleNamespace
+    command = SimpleNamespace(command_name="find", command={"find": "chums"}, reply={"ok": 1}, duration_micros=10)
+    encoded = []
+    monkeypatch.setattr(metrics.bson, "encode", lambda document: encoded.append(document) or b"12345")
+
+    @metrics.timed
+    def sampled_listener():
+        metrics.MongoMetrics().started(command)
+        metrics.MongoMetrics().succeeded(command)
+
+    def count(statistic):
+        return REGISTRY.get_sample_value(f"spotbot_mongo_{statistic}", {"listener": "sampled_listener"}) or 0
+
+    monkeypatch.setattr(metrics, "MONGO_BYTES_SAMPLE_RATE", 0)
+    sampled_listener()
+    assert encoded == []
+    assert count("round_trips_per_event_sum") == 1
+    assert count("bytes_per_event_count") == 0
+
+    monkeypatch.setattr(metrics, "MONGO_BYTES_SAMPLE_RATE", 1)
+    sampled_listener()
+    assert len(encoded) == 2
+    assert count("bytes_per_event_sum") == 10
@@ -0,0 +1,36 @@
+from datetime import datetime
+import time
+from scheduler import ReferendumScheduler, LEASE_NAME
+from utils import LeaseDatabase, ReferendumDatabase
+
+LEASE_SECONDS = 0.15
+
+
+def test_leases_held_while_a_batch_outlasts_them(client):
+    referenda = ReferendumDatabase(client, 0)
+    leases = LeaseDatabase(client)
+    for number in range(3):
+        referenda.store_referendum({"team_id": "T1", "number": number, "date": datetime.utcnow()})
+    processed = []
+    other = ReferendumScheduler(referenda, leases, None, None, LEASE_SECONDS)
+    taken = []
+
+    # Slow enough to outlast both leases several times over
+    def process(referendum, resolved):
+        time.sleep(LEASE_SECONDS * 3)
+        taken.append(leases.acquire(LEASE_NAME, other.owner, LEASE_SECONDS))
+        taken.extend(referenda.claim_expired(other.owner, LEASE_SECONDS, 10))
+        processed.append(referendum["number"])
+
+    scheduler = ReferendumScheduler(referenda, leases, lambda team_id: None, process, LEASE_SECONDS, workers=1)
+    scheduler.start()
+    try:
+        deadline = time.monotonic() + 10
+        while referenda.count_open("T1") and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        scheduler.stop()
+
+    assert sorted(processed) == [0, 1, 2]
+    assert taken == [False, False, False]
+    assert referenda.count_open("T1") == 0
@@ -0,0 +1,124 @@
+from datetime import datetime
+import pytest
+import utils
+from conftest import TEAM_ID, location
+from tenants import TenantQuotas
+from utils import TenantDatabase, ReferendumDatabase, legacy_location_identifier, team_of, team_range
+
+
+def record(database, loc_id, mid, spotted, images):
+    with database.session_for_loc(loc_id) as chums:
+        chums.record_chum(mid, "U1", spotted, images, "1700000000.000100")
+
+
+def usage(database, team_id=TEAM_ID):
+    tenant = database.tenants.find_one({"team_id": team_id}) or {}
+    return tenant.get("chums", 0), tenant.get("images", 0)
+
+
+def test_team_of():
+    assert team_of(location("C1")) == TEAM_ID
+    assert team_of(legacy_location_identifier({"channel": "C1"}, {"team_id": TEAM_ID})) is None
+
+
+def test_team_range_holds_only_the_team(database):
+    for team_id in ("T1", "T10", "T2"):
+        with database.session_for_loc(location("C1", team_id)) as chums:
+            chums.set_manager("U1")
+
+    found = database.collection.find({"loc_id": team_range("T1")})
+    assert [team_of(document["loc_id"]) for document in found] == ["T1"]
+
+
+def test_record_delete_and_drop_count_the_team(database):
+    loc_id = location("C1")
+    record(database, loc_id, "m1", ["U2", "U3"], ["https://files/1.jpg"])
+    record(database, loc_id, "m2", ["U2"], [])
+    record(database, location("C1", "T2"), "m1", ["U2"], [])
+    assert usage(database) == (2, 2)
+
+    with database.session_for_loc(loc_id) as chums:
+        chums.delete_chum("m1")
+    assert usage(database) == (1, 0)
+
+    record(database, loc_id, "m3", ["U2"], ["https://files/3.jpg", "https://files/4.jpg"])
+    database.session_for_loc(loc_id).drop_loc("U1")
+    assert usage(database) == (0, 0)
+    assert usage(database, "T2") == (1, 0)
+
+
+def test_recount(client, database):
+    record(database, location("C1"), "m1", ["U2"], ["https://files/1.jpg"])
+    database.tenants.delete_many({})
+
+    assert TenantDatabase(client).recount(TEAM_ID) == {"team_id": TEAM_ID, "chums": 1, "images": 1}
+    assert usage(database) == (1, 1)
+
+
+def test_rename_location(client, database, monkeypatch):
+    monkeypatch.setattr(utils, "RENAME_BATCH_SIZE", 2)
+    old = legacy_location_identifier({"channel": "C1"}, {"team_id": TEAM_ID})
+    new = location("C1")
+    with database.session_for_loc(old) as chums:
+        chums.set_manager("U9")
+        for number in range(5):
+            chums.record_chum(f"m{number}", "U1", ["U2", "U3"], ["https://files/1.jpg"], f"170000000{number}.000100")
+        chums.save_checkpoint("1700000000.000100", 5)
+    referenda = ReferendumDatabase(client, 60)
+    referenda.store_referendum({"team_id": TEAM_ID, "loc_id": old, "channel_id": "C1", "date": datetime.utcnow()})
+
+    assert database.rename_location(old, new)
+    assert not database.rename_location(old, new)
+
+    for collection in (database.collection, database.chums, database.counters, database.images,
+            database.rollups, database.edges, referenda.collection):
+        assert collection.count_documents({"loc_id": old}) == 0
+        assert collection.count_documents({"loc_id": new}) > 0
+    chums = database.session_for_loc(new)
+    assert chums.get_manager() == "U9"
+    assert chums.count_chums() == 5
+    assert chums.count_images("U3") == 5
+    assert database.get_checkpoint(old) is None
+    assert database.get_checkpoint(new)["count"] == 5
+
+
+def test_interrupted_rename_finishes_when_run_again(database, monkeypatch):
+    old = legacy_location_identifier({"channel": "C1"}, {"team_id": TEAM_ID})
+    new = location("C1")
+    with database.session_for_loc(old) as chums:
+        chums.set_manager("U9")
+        chums.record_chum("m1", "U1", ["U2"], ["https://files/1.jpg"], "1700000000.000100")
+        chums.save_checkpoint("1700000000.000100", 1)
+
+    def fail(*args, **kwargs):
+        raise ConnectionError("lost the connection to Mongo")
+    monkeypatch.setattr(database, "get_checkpoint", fail)
+    with pytest.raises(ConnectionError):
+        database.rename_location(old, new)
+    monkeypatch.undo()
+
+    assert database.rename_location(old, new)
+    assert database.session_for_loc(new).count_chums() == 1
+    assert database.session_for_loc(new).get_top_spotters(1) == [("U1", 1)]
+    assert database.get_checkpoint(new)["count"] == 1
+
+
+def test_chum_quota(client, database):
+    tenants = TenantDatabase(client)
+    quotas = TenantQuotas(tenants, 0, 2)
+    record(database, location("C1"), "m1", ["U2"], [])
+    assert quotas.allow_chum(TEAM_ID)
+
+    record(database, location("C2"), "m2", ["U2"], [])
+    tenants.cache.clear()
+    assert not quotas.allow_chum(TEAM_ID)
+    assert quotas.allow_chum("T2")
+    assert TenantQuotas(tenants, 0, 0).allow_chum(TEAM_ID)
+
+
+def test_command_quota(client):
+    quotas = TenantQuotas(TenantDatabase(client), 60, 0)
+    # A burst of BURST_SECONDS worth of commands, then nothing until the bucket refills
+    assert sum(quotas.allow_command(TEAM_ID) for _ in range(20)) == 10
+    assert quotas.allow_command("T2")
+    assert all(TenantQuotas(None, 0, 0).allow_command(TEAM_ID) for _ in range(100))
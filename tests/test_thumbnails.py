@@ -0,0 +1,55 @@
+import os, urllib.request
+import pytest
+from thumbnails import ThumbnailCache, SlackFileRedirectHandler, fetch_private_file
+
+
+def test_no_files_touched_until_used(tmp_path):
+    directory = tmp_path / "thumbnails"
+    cache = ThumbnailCache(str(directory), 100)
+    assert not directory.exists()
+
+    assert "a" not in cache
+    assert directory.is_dir()
+
+
+def test_reads_existing_files_least_recent_first(tmp_path):
+    for age, digest in enumerate(["new", "old"]):
+        path = tmp_path / digest
+        path.write_bytes(b"x" * 40)
+        os.utime(path, (1000 - age, 1000 - age))
+    (tmp_path / "partial.tmp").write_bytes(b"x")
+
+    cache = ThumbnailCache(str(tmp_path), 100)
+    cache.put("third", b"y" * 40)
+
+    assert "old" not in cache
+    assert not (tmp_path / "old").exists()
+    assert cache.get("new") == b"x" * 40
+    assert cache.get("third") == b"y" * 40
+    assert cache.size == 80
+
+
+def test_token_only_sent_to_slack_files():
+    with pytest.raises(ValueError):
+        fetch_private_file("https://example.com/files/1.jpg", "xoxb-test")
+    with pytest.raises(ValueError):
+        fetch_private_file("http://files.slack.com/files-pri/1.jpg", "xoxb-test")
+
+    request = urllib.request.Request("https://files.slack.com/files-pri/1.jpg", headers={"Authorization": "Bearer xoxb-test"})
+    handler = SlackFileRedirectHandler()
+    within = handler.redirect_request(request, None, 302, "Found", {}, "https://files.slack.com/files-pri/2.jpg")
+    elsewhere = handler.redirect_request(request, None, 302, "Found", {}, "https://example.com/1.jpg")
+    assert within.get_header("Authorization") == "Bearer xoxb-test"
+    assert not elsewhere.has_header("Authorization")
+
+
+def test_workers_share_the_directory_and_its_bound(tmp_path):
+    workers = [ThumbnailCache(str(tmp_path), 100) for _ in range(2)]
+    workers[0].put("first", b"x" * 40)
+    assert "first" in workers[1]
+    assert workers[1].get("first") == b"x" * 40
+
+    for number in range(10):
+        workers[number % 2].put(f"digest{number}", b"y" * 30)
+        assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 100
+    assert workers[0].get("digest9") == b"y" * 30
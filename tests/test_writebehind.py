@@ -0,0 +1,78 @@
+import pymongo.errors, pytest
+from conftest import TEAM_ID, location
+from writebehind import PendingWrites, WriteBehind
+
+
+@pytest.fixture
+def write_behind(database):
+    database.write_behind = WriteBehind(database, 60, 1000)
+    return database.write_behind
+
+
+def record(database, loc_id, mid, images):
+    with database.session_for_loc(loc_id) as chums:
+        chums.record_chum(mid, "U1", ["U2"], images, "1700000000.000100")
+
+
+def test_take_leaves_no_empty_batches():
+    pending = PendingWrites()
+    pending.insert("images", {"loc_id": "A"})
+    pending.increment("tenants", {"team_id": TEAM_ID}, "chums", 1)
+    pending.increment("counters", {"loc_id": "B", "user": "U1"}, "spot", 0)
+
+    taken = pending.take("A")
+    assert taken.operations().keys() == {"images"}
+    assert pending.inserts == {}
+    assert pending.take("A").operations() == {}
+    # An increment that adds up to nothing is not written
+    assert pending.take("B").operations() == {}
+
+
+def test_periodic_flushes_after_read(database, write_behind):
+    loc_id = location("C1")
+    record(database, loc_id, "m1", ["https://files/1.jpg"])
+    assert database.session_for_loc(loc_id).get_top_spotters(1) == [("U1", 1)]
+    for _ in range(3):
+        write_behind.flush()
+
+    assert write_behind.depth() == 0
+    tenant = database.tenants.find_one({"team_id": TEAM_ID})
+    assert (tenant["chums"], tenant["images"]) == (1, 1)
+
+
+def test_two_channels_counted_once(database, write_behind):
+    first, second = location("C1"), location("C2")
+    record(database, first, "m1", ["https://files/1.jpg"])
+    record(database, second, "m2", [])
+    for _ in range(3):
+        database.session_for_loc(first).get_top_spotters(1)
+        write_behind.flush()
+
+    assert database.session_for_loc(first).get_top_spotters(1) == [("U1", 1)]
+    assert database.session_for_loc(second).get_top_spotters(1) == [("U1", 1)]
+    assert database.tenants.find_one({"team_id": TEAM_ID})["chums"] == 2
+
+
+def test_failed_flush_retries_only_unwritten(database, write_behind, monkeypatch):
+    loc_id = location("C1")
+    record(database, loc_id, "m1", ["https://files/1.jpg"])
+    images = database.db.get_collection("images")
+    monkeypatch.setattr(type(images), "bulk_write", failing_on(images.name, type(images).bulk_write))
+
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        write_behind.flush()
+    monkeypatch.undo()
+    write_behind.flush()
+
+    assert database.session_for_loc(loc_id).get_top_spotters(1) == [("U1", 1)]
+    assert database.tenants.find_one({"team_id": TEAM_ID})["chums"] == 1
+    assert database.session_for_loc(loc_id).count_images("U2") == 1
+
+
+def failing_on(name, bulk_write):
+    # Stops before the first write, as an ordered bulk write does on a write error
+    def fail(collection, requests, **kwargs):
+        if collection.name == name:
+            raise pymongo.errors.BulkWriteError({"writeErrors": [{"index": 0, "code": 91}], "nInserted": 0})
+        return bulk_write(collection, requests, **kwargs)
+    return fail
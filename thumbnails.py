@@ -0,0 +1,243 @@
+from collections import OrderedDict
+from logs import fields
+import hashlib, io, logging, os, queue, tempfile, threading, urllib.parse, urllib.request
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = 160
+SHEET_COLUMNS = 5
+SHEET_BACKGROUND = (255, 255, 255)
+LABEL_BACKGROUND = (0, 0, 0)
+LABEL_TEXT = (255, 255, 255)
+FETCH_TIMEOUT_SECONDS = 30
+MAX_IMAGE_BYTES = 50 * 1024 * 1024
+# The only host the bot token is sent to
+SLACK_FILE_HOST = "files.slack.com"
+
+
+def is_slack_file(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme == "https" and parts.hostname == SLACK_FILE_HOST
+
+# Follows redirects, but drops the bot token on those that leave Slack's file host.
+class SlackFileRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        redirected = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if redirected is not None and not is_slack_file(newurl):
+            redirected.remove_header("Authorization")
+        return redirected
+
+opener = urllib.request.build_opener(SlackFileRedirectHandler)
+
+# Downloads a url_private file with the workspace's bot token (files:read).
+# Image urls can come from an imported file, so only Slack's own are fetched.
+def fetch_private_file(url, token):
+    if not is_slack_file(url):
+        raise ValueError(f"{url} is not a Slack file")
+    request = urllib.request.Request(url, headers={"Authorization": f"Bearer {token}"})
+    with opener.open(request, timeout=FETCH_TIMEOUT_SECONDS) as response:
+        data = response.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f"{url} is larger than {MAX_IMAGE_BYTES} bytes")
+    return data
+
+# Pillow is imported on first use, as it is slow to import and most processes
+# never make a thumbnail before they have served their first event.
+def make_thumbnail(data):
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=80)
+        return output.getvalue()
+
+# Lays thumbnails out in a numbered grid, returned as a JPEG. Numbers start
+# at first, matching the positions in the pics listing.
+def make_contact_sheet(thumbnails, first=1):
+    from PIL import Image, ImageDraw
+    columns = min(SHEET_COLUMNS, len(thumbnails))
+    rows = (len(thumbnails) + columns - 1) // columns
+    sheet = Image.new("RGB", (columns * THUMBNAIL_SIZE, rows * THUMBNAIL_SIZE), SHEET_BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+    for i, data in enumerate(thumbnails):
+        left, top = (i % columns) * THUMBNAIL_SIZE, (i // columns) * THUMBNAIL_SIZE
+        with Image.open(io.BytesIO(data)) as thumbnail:
+            sheet.paste(thumbnail, (left + (THUMBNAIL_SIZE - thumbnail.width) // 2, top + (THUMBNAIL_SIZE - thumbnail.height) // 2))
+        label = draw.textbbox((left + 4, top + 4), str(first + i))
+        draw.rectangle((label[0] - 2, label[1] - 2, label[2] + 2, label[3] + 2), fill=LABEL_BACKGROUND)
+        draw.text((left + 4, top + 4), str(first + i), fill=LABEL_TEXT)
+    output = io.BytesIO()
+    sheet.save(output, "JPEG", quality=85)
+    return output.getvalue()
+
+
+# Thumbnails on disk, named by the SHA-256 of the original image so a picture
+# shared in several chums is stored once. The least recently used files are
+# deleted once the directory holds more than max_bytes. Every worker process
+# shares the directory: a worker picks up thumbnails the others made, and
+# rescans the directory after each write so the bound holds for all of them.
+class ThumbnailCache():
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # digest -> size, least recently used first, or None until loaded
+        self.entries = None
+        self.size = 0
+
+    # Creates the directory and reads what it holds, once. Called on first
+    # use rather than at import, as the directory may hold thousands of files.
+    def load(self):
+        if self.entries is not None:
+            return
+        with self.lock:
+            if self.entries is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.entries, self.size = self.scan()
+
+    # (digest -> size, least recently used first; total size) of the files in
+    # the directory. Access times are kept, across restarts and workers, as
+    # file modification times.
+    def scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    files.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+            except FileNotFoundError:
+                # Evicted by another worker meanwhile
+                pass
+        entries = OrderedDict((name, size) for _, name, size in sorted(files))
+        return entries, sum(entries.values())
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def __contains__(self, digest):
+        self.load()
+        with self.lock:
+            if digest in self.entries:
+                return True
+        # Another worker may have made it
+        try:
+            size = os.stat(self.path(digest)).st_size
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            if digest not in self.entries:
+                self.entries[digest] = size
+                self.size += size
+        return True
+
+    def get(self, digest):
+        if digest not in self:
+            return None
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+        try:
+            os.utime(self.path(digest))
+            with open(self.path(digest), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.entries.pop(digest, 0)
+            return None
+
+    def put(self, digest, data):
+        self.load()
+        # Written aside and renamed, so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as file:
+            file.write(data)
+        os.replace(file.name, self.path(digest))
+        # Counts what the other workers wrote and evicted as well. Outside the
+        # lock, so reads carry on meanwhile.
+        entries, size = self.scan()
+        with self.lock:
+            self.entries, self.size = entries, size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted, size = self.entries.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(self.path(evicted))
+                except FileNotFoundError:
+                    pass
+
+
+# Fetches images on background threads and caches their thumbnails, then
+# calls on_thumbnail(image, digest). The fetcher is injectable so a local
+# stand-in can replace Slack. Images already queued are not queued twice, and
+# when the queue is full new ones are dropped until the next request for them.
+class ThumbnailWorker():
+    def __init__(self, cache, on_thumbnail, fetch=fetch_private_file, workers=2, queue_size=1000):
+        self.cache = cache
+        self.on_thumbnail = on_thumbnail
+        self.fetch = fetch
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.threads = []
+        # Called after an image is queued or taken
+        self.on_change = None
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    # image is the image document: loc_id, mid and url at least.
+    def submit(self, image, token):
+        with self.lock:
+            if image["url"] in self.queued:
+                return
+            self.queued.add(image["url"])
+        try:
+            self.queue.put_nowait((image, token))
+        except queue.Full:
+            with self.lock:
+                self.queued.discard(image["url"])
+            return
+        self.changed()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+    # Drops thumbnails not started yet; they are queued again when next needed.
+    def shutdown(self):
+        while True:
+            try:
+                image, _ = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.queued.discard(image["url"])
+        self.changed()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.changed()
+            image, token = item
+            try:
+                data = self.fetch(image["url"], token)
+                digest = hashlib.sha256(data).hexdigest()
+                if digest not in self.cache:
+                    self.cache.put(digest, make_thumbnail(data))
+                self.on_thumbnail(image, digest)
+            except Exception:
+                logger.exception("Encountered an exception while making a thumbnail", extra=fields(url=image["url"]))
+            finally:
+                with self.lock:
+                    self.queued.discard(image["url"])
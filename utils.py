@@ -1,10 +1,12 @@
 from slack_sdk.oauth.installation_store import InstallationStore, Installation, Bot
 from slack_sdk.oauth.state_store import OAuthStateStore
 from typing import Optional
-import pymongo, string, random, re
-from pymongo.collection import ReturnDocument
+import pymongo, pymongo.errors, string, random, re
 from datetime import datetime, timedelta
-import hashlib
+import hashlib, logging
+from cache import TTLCache
+from logs import fields, sampled
+from writebehind import PendingWrites
 
 
 CONFIG_DATABASE_NAME = "spot-bot-config"
@@ -21,7 +23,47 @@ MESSAGES = "messages"
 IMAGES = "images"
 MANAGER = "manager"
 
+CHUM_COLLECTION_NAME = "chums"
+COUNTER_COLLECTION_NAME = "counters"
+IMAGE_COLLECTION_NAME = "images"
+ROLLUP_COLLECTION_NAME = "rollups"
+EDGE_COLLECTION_NAME = "edges"
+DAY_FORMAT = "%Y-%m-%d"
+
 REFERENDUM_COLLECTION_NAME = "referenda"
+CHECKPOINT_COLLECTION_NAME = "backfill-checkpoints"
+LEASE_COLLECTION_NAME = "leases"
+PROCESSED_EVENT_COLLECTION_NAME = "processed-events"
+PROCESSED_EVENT_CACHE_SIZE = 10000
+TENANT_COLLECTION_NAME = "tenants"
+TENANT_CACHE_SIZE = 1000
+TENANT_CACHE_SECONDS = 60
+# Joins a location's team id to the hash of its channel
+TEAM_SEPARATOR = ":"
+RENAME_BATCH_SIZE = 1000
+
+REFERENDUM_PROMPT = "Good chum :+1: or bad chum :-1:? "
+CHUM_IS_GOOD = "The chum is good! "
+CHUM_IS_BAD = "The chum is bad. "
+
+INSTALLATION_CACHE_SIZE = 1000
+INSTALLATION_CACHE_SECONDS = 300
+BOT_USER_CACHE_SIZE = 1000
+BOT_USER_CACHE_SECONDS = 3600
+DISPLAY_NAME_CACHE_SIZE = 10000
+DISPLAY_NAME_CACHE_SECONDS = 600
+
+logger = logging.getLogger(__name__)
+
+# Keyed by team_id
+bot_users = TTLCache(BOT_USER_CACHE_SIZE, BOT_USER_CACHE_SECONDS)
+# Keyed by (team_id, user)
+display_names = TTLCache(DISPLAY_NAME_CACHE_SIZE, DISPLAY_NAME_CACHE_SECONDS)
+
+# Server error code for duplicate keys in a unique index
+DUPLICATE_KEY = 11000
+# Server error code for "Transaction numbers are only allowed on a replica set member or mongos"
+ILLEGAL_OPERATION = 20
 
 def remove_nones(dictionary):
     out = {}
@@ -35,17 +77,31 @@ class DatabaseInstallationStore(InstallationStore):
         db = client.get_database(CONFIG_DATABASE_NAME)
         self.install_collection = db.get_collection(INSTALL_COLLECTION_NAME)
         self.bot_collection = db.get_collection(BOT_COLLECTION_NAME)
+        # Keyed by (method, enterprise_id, team_id, user_id, is_enterprise_install)
+        self.cache = TTLCache(INSTALLATION_CACHE_SIZE, INSTALLATION_CACHE_SECONDS)
+
+    def invalidate_team(self, team_id):
+        self.cache.invalidate_where(lambda key: key[2] == team_id)
 
     def save(self, installation: Installation):
-        print("Saving installation to installation store. ")
+        logger.info("Saving installation to installation store", extra=fields(team_id=installation.team_id))
         self.install_collection.insert_one(installation.to_dict())
+        self.invalidate_team(installation.team_id)
 
     def save_bot(self, bot: Bot):
-        print("Saving bot to installation store. ")
+        logger.info("Saving bot to installation store", extra=fields(team_id=bot.team_id))
         self.bot_collection.insert_one(bot.to_dict())
+        self.invalidate_team(bot.team_id)
+
+    def team_ids(self):
+        return self.install_collection.distinct("team_id")
 
     def find_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str], is_enterprise_install: Optional[bool] = False) -> Optional[Bot]:
-        print("Finding in bot store. ")
+        return self.cache.get_or_load(("bot", enterprise_id, team_id, None, is_enterprise_install), 
+            lambda: self.load_bot(enterprise_id=enterprise_id, team_id=team_id, is_enterprise_install=is_enterprise_install))
+
+    def load_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str], is_enterprise_install: Optional[bool] = False) -> Optional[Bot]:
+        logger.info("Finding in bot store", extra=sampled(team_id=team_id))
         query = dict(
             enterprise_id=enterprise_id,
             team_id=team_id,
@@ -59,7 +115,11 @@ class DatabaseInstallationStore(InstallationStore):
         return None
 
     def find_installation(self, *, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str] = None, is_enterprise_install: Optional[bool] = False):
-        print("Finding in installation store. ")
+        return self.cache.get_or_load(("installation", enterprise_id, team_id, user_id, is_enterprise_install), 
+            lambda: self.load_installation(enterprise_id=enterprise_id, team_id=team_id, user_id=user_id, is_enterprise_install=is_enterprise_install))
+
+    def load_installation(self, *, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str] = None, is_enterprise_install: Optional[bool] = False):
+        logger.info("Finding in installation store", extra=sampled(team_id=team_id, user_id=user_id))
         query = dict(
             enterprise_id=enterprise_id,
             team_id=team_id,
@@ -78,7 +138,7 @@ class DatabaseInstallationStore(InstallationStore):
         return None
 
     def delete_installation(self, *, enterprise_id: Optional[str], team_id: Optional[str], user_id: Optional[str] = None):
-        print("Deleting installation.")
+        logger.info("Deleting installation", extra=fields(team_id=team_id, user_id=user_id))
         query = dict(
             enterprise_id=enterprise_id,
             team_id=team_id,
@@ -86,15 +146,17 @@ class DatabaseInstallationStore(InstallationStore):
         )
         query = remove_nones(query)
         self.install_collection.delete_one(query)
+        self.invalidate_team(team_id)
 
     def delete_bot(self, *, enterprise_id: Optional[str], team_id: Optional[str]) -> None:
-        print("Deleting bot.")
+        logger.info("Deleting bot", extra=fields(team_id=team_id))
         query = dict(
             enterprise_id=enterprise_id,
             team_id=team_id,
         )
         query = remove_nones(query)
         self.bot_collection.delete_one(query)
+        self.invalidate_team(team_id)
 
 class DatabaseOAuthStateStore(OAuthStateStore):
     def __init__(self, client, expiration_seconds):
@@ -103,7 +165,7 @@ class DatabaseOAuthStateStore(OAuthStateStore):
         self.expiration_seconds = expiration_seconds
 
     def issue(self):
-        print("Issuing OAuth state. ")
+        logger.info("Issuing OAuth state", extra=sampled())
         rand = random.SystemRandom()
         alphabet = string.ascii_letters + string.digits + "-_"
         state = "".join([rand.choice(alphabet) for _ in range(20)])
@@ -111,27 +173,163 @@ class DatabaseOAuthStateStore(OAuthStateStore):
         return state
 
     def consume(self, state: str):
-        print("Consuming OAuth state. ")
-        self.collection.delete_many({"date" : {"$lt" : datetime.utcnow() - timedelta(seconds=self.expiration_seconds)} })
-        return bool(self.collection.find_one_and_delete({"data": state}))
-
+        logger.info("Consuming OAuth state", extra=sampled())
+        # The TTL index only deletes expired states about once a minute
+        return bool(self.collection.find_one_and_delete({
+            "data": state,
+            "date": {"$gte": datetime.utcnow() - timedelta(seconds=self.expiration_seconds)}
+        }))
+
+# Location ids start with the team id, so each workspace's documents sort
+# together in every collection, ready to be sharded or zoned by workspace.
 def unique_location_identifier(event, body):
+    return body["team_id"] + TEAM_SEPARATOR + legacy_location_identifier(event, body)
+
+# Location ids from before they were prefixed, still used for their hash.
+def legacy_location_identifier(event, body):
     return hashlib.sha256(bytes(event["channel"] + body["team_id"], encoding="utf-8")).hexdigest()
 
+def team_of(loc_id):
+    team_id, separator, _ = loc_id.partition(TEAM_SEPARATOR)
+    return team_id if separator else None
+
+# Filter matching every location id of the team. The separator is followed by
+# ";" in ASCII, so this is one index range.
+def team_range(team_id):
+    return {"$gte": team_id + TEAM_SEPARATOR, "$lt": team_id + chr(ord(TEAM_SEPARATOR) + 1)}
+
 class SpotDatabase():
     def __init__(self, client):
         db = client.get_database(MAIN_DATABASE_NAME)
+        self.client = client
+        self.db = db
         self.collection = db.get_collection(MAIN_COLLECTION_NAME)
-        self.operations = []
-
-    def configure_for_message(self, event, body):
-        self.loc_id = unique_location_identifier(event, body)
-
-    def configure_for_loc(self, loc_id):
+        self.chums = db.get_collection(CHUM_COLLECTION_NAME)
+        self.counters = db.get_collection(COUNTER_COLLECTION_NAME)
+        self.images = db.get_collection(IMAGE_COLLECTION_NAME)
+        self.rollups = db.get_collection(ROLLUP_COLLECTION_NAME)
+        self.edges = db.get_collection(EDGE_COLLECTION_NAME)
+        self.checkpoints = db.get_collection(CHECKPOINT_COLLECTION_NAME)
+        self.tenants = db.get_collection(TENANT_COLLECTION_NAME)
+        self.referenda = db.get_collection(REFERENDUM_COLLECTION_NAME)
+        self.transactions = True
+        # Set to a WriteBehind to defer counter increments and image inserts
+        self.write_behind = None
+
+    def session_for_message(self, event, body):
+        return ChumSession(self, unique_location_identifier(event, body))
+
+    # Backfills pass write_behind=False so their checkpoints never get ahead of the counters.
+    def session_for_loc(self, loc_id, write_behind=True):
+        return ChumSession(self, loc_id, write_behind)
+
+    def get_checkpoint(self, loc_id):
+        return self.checkpoints.find_one({"_id": loc_id})
+
+    def clear_checkpoint(self, loc_id):
+        self.checkpoints.delete_one({"_id": loc_id})
+
+    def run_atomically(self, callback):
+        # Standalone mongod (and mongomock) cannot run transactions, so fall 
+        # back to plain writes there. A failed transaction has written nothing. 
+        if self.transactions:
+            try:
+                with self.client.start_session() as session:
+                    return session.with_transaction(callback)
+            except NotImplementedError:
+                self.transactions = False
+            except pymongo.errors.OperationFailure as e:
+                if e.code != ILLEGAL_OPERATION:
+                    raise
+                self.transactions = False
+            logger.warning("Transactions are unavailable, writing without them")
+        return callback(None)
+
+    # One-shot migration from the single per-channel document (spot, caught, 
+    # images and messages maps) to the chums, counters and images collections. 
+    # Run it once while deploying, before the new listeners take traffic. 
+    def migrate_legacy_locations(self):
+        legacy_fields = [SPOT, CAUGHT, IMAGES, MESSAGES]
+        migrated = 0
+        for document in self.collection.find({"$or": [{field: {"$exists": True}} for field in legacy_fields]}):
+            with self.session_for_loc(document["loc_id"], write_behind=False) as chums:
+                for username, amount in document.get(SPOT, {}).items():
+                    chums.increment_spot(username, amount)
+                for username, amount in document.get(CAUGHT, {}).items():
+                    chums.increment_caught(username, amount)
+
+                for mid, message in document.get(MESSAGES, {}).items():
+                    if "spotter" not in message:
+                        # Referendum markers on messages that were never logged
+                        continue
+                    chums.increment_daily_spot(message["spotter"], message["ts"], len(message["spotted"]))
+                    for username in message["spotted"]:
+                        chums.increment_edge(message["spotter"], username, 1)
+                    chums.plan_write(pymongo.UpdateOne(
+                        filter={"loc_id": chums.loc_id, "mid": mid},
+                        update={"$setOnInsert": dict(message, loc_id=chums.loc_id, mid=mid)},
+                        upsert=True
+                    ), CHUM_COLLECTION_NAME)
+                    for username in message["spotted"]:
+                        for index, url in enumerate(message["images"]):
+                            chums.plan_write(pymongo.UpdateOne(
+                                filter={"loc_id": chums.loc_id, "user": username, "mid": mid, "index": index},
+                                update={"$setOnInsert": {"ts": message["ts"], "url": url}},
+                                upsert=True
+                            ), IMAGE_COLLECTION_NAME)
+
+                for field in legacy_fields:
+                    chums.unset(field)
+            migrated += 1
+        return migrated
+
+    # Moves a channel's documents and referenda to a new location id,
+    # RENAME_BATCH_SIZE documents at a time. A large channel would outlast a
+    # transaction, so the main document moves last instead: an interrupted
+    # rename is finished by running it again. Returns whether the channel had
+    # any. Run while no listener is writing to the channel.
+    def rename_location(self, old, new):
+        if not self.collection.find_one({"loc_id": old}, projection={"_id": True}):
+            return False
+        for collection in (self.chums, self.counters, self.images, self.rollups, self.edges, self.referenda):
+            while True:
+                batch = [document["_id"] for document in collection.find({"loc_id": old}, projection={"_id": True}, limit=RENAME_BATCH_SIZE)]
+                if not batch:
+                    break
+                collection.update_many({"_id": {"$in": batch}}, {"$set": {"loc_id": new}})
+        checkpoint = self.get_checkpoint(old)
+        if checkpoint:
+            self.checkpoints.replace_one({"_id": new}, dict(checkpoint, _id=new), upsert=True)
+            self.clear_checkpoint(old)
+        self.collection.update_one({"loc_id": old}, {"$set": {"loc_id": new}})
+        return True
+
+# Unit of work for one event in one channel. Reads go straight to the 
+# database, writes are planned and committed together when the session 
+# exits cleanly, or discarded if the handler raised. 
+class ChumSession():
+    def __init__(self, database, loc_id, write_behind=True):
+        self.database = database
         self.loc_id = loc_id
+        self.team_id = team_of(loc_id)
+        self.write_behind = write_behind
+        self.operations = {}
+        self.pending = PendingWrites()
+        self.deletions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.operations.clear()
+            self.pending = PendingWrites()
+            self.deletions.clear()
 
     def get(self, projection):
-        return self.collection.find_one(filter={"loc_id": self.loc_id}, 
+        return self.database.collection.find_one(filter={"loc_id": self.loc_id}, 
             projection=projection)
 
     def get_recent(self):
@@ -146,45 +344,151 @@ class SpotDatabase():
             return 
         return result[MANAGER]
 
+    # Reads of counters, rollups, edges and images call this first, so they
+    # include this process's buffered writes.
+    def flush_buffered(self):
+        if self.database.write_behind:
+            self.database.write_behind.flush(self.loc_id)
+
+    def get_top_spotters(self, n):
+        self.flush_buffered()
+        counters = self.database.counters.find(
+            filter={"loc_id": self.loc_id, SPOT: {"$exists": True}},
+            projection={"user": True, SPOT: True, "_id": False},
+            sort=[(SPOT, pymongo.DESCENDING), ("user", pymongo.ASCENDING)],
+            limit=n
+        )
+        return [(counter["user"], counter[SPOT]) for counter in counters]
+
+    # Both days are inclusive, formatted as DAY_FORMAT. 
+    def get_top_spotters_between(self, start_day, end_day, n):
+        self.flush_buffered()
+        totals = self.database.rollups.aggregate([
+            {"$match": {"loc_id": self.loc_id, "day": {"$gte": start_day, "$lte": end_day}}},
+            {"$group": {"_id": "$user", SPOT: {"$sum": f"${SPOT}"}}},
+            {"$match": {SPOT: {"$ne": 0}}},
+            {"$sort": {SPOT: pymongo.DESCENDING, "_id": pymongo.ASCENDING}},
+            {"$limit": n}
+        ])
+        return [(total["_id"], total[SPOT]) for total in totals]
+
+    def count_chums(self):
+        return self.database.chums.count_documents({"loc_id": self.loc_id})
+
+    # Every chum in the channel, oldest first, fetched a batch at a time.
+    # The message ids among mids that are logged in this channel
+    def get_logged(self, mids):
+        if not mids:
+            return set()
+        logged = self.database.chums.find({"loc_id": self.loc_id, "mid": {"$in": list(mids)}}, projection={"mid": True, "_id": False})
+        return {chum["mid"] for chum in logged}
+
+    def iter_chums(self, batch_size=1000):
+        return self.database.chums.find(
+            filter={"loc_id": self.loc_id},
+            projection={"_id": False, "loc_id": False},
+            sort=[("ts", pymongo.ASCENDING)],
+            batch_size=batch_size
+        )
+
+    def count_images(self, username):
+        self.flush_buffered()
+        return self.database.images.count_documents({"loc_id": self.loc_id, "user": username})
+
+    # Walks the (loc_id, user, ts, index) index, so only the requested slice
+    # and the skipped index keys are read. Pages are numbered by users in
+    # "pics @user page 2", which carries no cursor to resume from, hence skip.
+    def get_images(self, username, skip=0, limit=0, newest_first=False):
+        self.flush_buffered()
+        direction = pymongo.DESCENDING if newest_first else pymongo.ASCENDING
+        images = self.database.images.find(
+            filter={"loc_id": self.loc_id, "user": username},
+            projection={"url": True, "mid": True, "thumbnail": True, "_id": False},
+            sort=[("ts", direction), ("index", direction)],
+            skip=skip,
+            limit=limit
+        )
+        return list(images)
+
+    # Images first to first + limit, oldest first, of the user's total. Pages
+    # past the middle are read from the newest end, so no page skips more
+    # than half the images.
+    def get_image_page(self, username, first, limit, total):
+        limit = min(limit, total - first)
+        if limit <= 0:
+            return []
+        if first <= total // 2:
+            return self.get_images(username, skip=first, limit=limit)
+        return self.get_images(username, skip=total - first - limit, limit=limit, newest_first=True)[::-1]
+
+    # Who the user chummed (outgoing) or was chummed by, most often first.
+    def get_edges(self, username, outgoing, limit=0):
+        self.flush_buffered()
+        this_end, other_end = ("spotter", "spotted") if outgoing else ("spotted", "spotter")
+        edges = self.database.edges.find(
+            filter={"loc_id": self.loc_id, this_end: username, "count": {"$gt": 0}},
+            projection={other_end: True, "count": True, "_id": False},
+            sort=[("count", pymongo.DESCENDING)],
+            limit=limit
+        )
+        return [(edge[other_end], edge["count"]) for edge in edges]
+
+    # Users the user both chummed and was chummed by, read from the user's own edges.
+    def get_mutual_chums(self, username):
+        chummed = dict(self.get_edges(username, outgoing=True))
+        return [(other, count + chummed[other]) for other, count in self.get_edges(username, outgoing=False) if other in chummed]
+
+    def get_top_pairs(self, n):
+        self.flush_buffered()
+        edges = self.database.edges.find(
+            filter={"loc_id": self.loc_id, "count": {"$gt": 0}},
+            projection={"spotter": True, "spotted": True, "count": True, "_id": False},
+            sort=[("count", pymongo.DESCENDING)],
+            limit=n
+        )
+        return [(edge["spotter"], edge["spotted"], edge["count"]) for edge in edges]
+
     def drop_loc(self, manager):
-        return self.collection.replace_one(
+        self.flush_buffered()
+        chums = self.database.chums.delete_many({"loc_id": self.loc_id}).deleted_count
+        images = self.database.images.delete_many({"loc_id": self.loc_id}).deleted_count
+        for collection in (self.database.counters, self.database.rollups, self.database.edges):
+            collection.delete_many({"loc_id": self.loc_id})
+        if self.team_id:
+            self.database.tenants.update_one(
+                filter={"team_id": self.team_id},
+                update={"$inc": {"chums": -chums, "images": -images}},
+                upsert=True
+            )
+        return self.database.collection.replace_one(
             filter={"loc_id": self.loc_id},
             replacement={
                 "loc_id": self.loc_id, 
                 MANAGER: manager
             })
 
-    def delete_message(self, message_id):
-        result = self.collection.find_one_and_update(
-            filter={"loc_id": self.loc_id},
-            update={"$unset": {f"{MESSAGES}.{message_id}": ""}}, 
-            projection={f"{MESSAGES}.{message_id}": True},
-            return_document=ReturnDocument.BEFORE
+    def set_thumbnail(self, mid, url, digest):
+        self.database.images.update_many(
+            filter={"loc_id": self.loc_id, "mid": mid, "url": url},
+            update={"$set": {"thumbnail": digest}}
         )
 
-        if result and "messages" in result and message_id in result["messages"]:
-            print(result)
-            return result["messages"][message_id]
-
     def set_referendum(self, mid, value):
-        result = self.collection.find_one_and_update(
-            filter={"loc_id": self.loc_id}, 
-            update={"$set": 
-                {f"{MESSAGES}.{mid}.referendum": value}
-            },
-            projection={f"{MESSAGES}.{mid}.referendum": True},
-            upsert=True        
+        result = self.database.chums.find_one_and_update(
+            filter={"loc_id": self.loc_id, "mid": mid}, 
+            update={"$set": {"referendum": value}},
+            projection={"referendum": True}
         )
 
-        if not (result and MESSAGES in result and mid in result[MESSAGES]):
+        if not result:
             return None
 
-        return result[MESSAGES][mid]["referendum"]
+        return result["referendum"]
 
     #=================================
 
-    def plan_write(self, operation):
-        self.operations.append(operation)
+    def plan_write(self, operation, collection=MAIN_COLLECTION_NAME):
+        self.operations.setdefault(collection, []).append(operation)
 
     def update_value(self, path, operation, argument):
         self.plan_write(pymongo.UpdateOne(
@@ -195,20 +499,41 @@ class SpotDatabase():
             upsert=True        
         ))
 
-    def increment(self, path, amount):
-        self.update_value(path, "$inc", amount)
+    def increment_counter(self, username, path, amount):
+        self.pending.increment(COUNTER_COLLECTION_NAME, {"loc_id": self.loc_id, "user": username}, path, amount)
 
     def increment_spot(self, username, amount):
-        self.increment(f"{SPOT}.{username}", amount)
+        self.increment_counter(username, SPOT, amount)
 
     def increment_caught(self, username, amount):
-        self.increment(f"{CAUGHT}.{username}", amount)
-
-    def append(self, path, lst): 
-        self.update_value(path, "$push", lst)
-
-    def append_images(self, username, images):
-        self.append(f"{IMAGES}.{username}", images)
+        self.increment_counter(username, CAUGHT, amount)
+
+    def increment_edge(self, spotter, spotted, amount):
+        self.pending.increment(EDGE_COLLECTION_NAME, {"loc_id": self.loc_id, "spotter": spotter, "spotted": spotted}, "count", amount)
+
+    def increment_daily_spot(self, username, ts, amount):
+        self.pending.increment(ROLLUP_COLLECTION_NAME, {"loc_id": self.loc_id, "day": day_of(ts), "user": username}, SPOT, amount)
+
+    # The workspace's totals, read for its stats and quotas
+    def increment_tenant(self, chums, images):
+        if self.team_id:
+            self.pending.increment(TENANT_COLLECTION_NAME, {"team_id": self.team_id}, "chums", chums)
+            self.pending.increment(TENANT_COLLECTION_NAME, {"team_id": self.team_id}, "images", images)
+
+    def add_images(self, username, message_id, ts, images):
+        for index, image in enumerate(images):
+            self.pending.insert(IMAGE_COLLECTION_NAME, dict(image_record(image),
+                loc_id=self.loc_id,
+                user=username,
+                mid=message_id,
+                ts=ts,
+                index=index
+            ))
+
+    def remove_images(self, username, message_id):
+        self.plan_write(pymongo.DeleteMany(
+            {"loc_id": self.loc_id, "user": username, "mid": message_id}
+        ), IMAGE_COLLECTION_NAME)
 
     def set(self, path, attribute):
         self.update_value(path, "$set", attribute)
@@ -216,8 +541,55 @@ class SpotDatabase():
     def unset(self, path):
         self.update_value(path, "$unset", "")
 
+    def record_chum(self, message_id, spotter, spotted, images, ts, referendum=False):
+        self.increment_spot(spotter, len(spotted))
+        self.increment_daily_spot(spotter, ts, len(spotted))
+        for user in spotted:
+            self.increment_caught(user, 1)
+            self.increment_edge(spotter, user, 1)
+            self.add_images(user, message_id, ts, images)
+        self.increment_tenant(1, len(spotted) * len(images))
+
+        self.add_message(message_id, {
+            "spotter": spotter,
+            "spotted": spotted,
+            "images": images,
+            "ts": ts,
+            "referendum": referendum
+        })
+
+    # Plans the writes that undo record_chum for a chum read back from the database.
+    def unrecord_chum(self, message_id, message):
+        self.increment_spot(message["spotter"], -len(message["spotted"]))
+        self.increment_tenant(-1, -len(message["spotted"]) * len(message["images"]))
+        self.increment_daily_spot(message["spotter"], message["ts"], -len(message["spotted"]))
+        for user in message["spotted"]:
+            self.increment_caught(user, -1)
+            self.increment_edge(message["spotter"], user, -1)
+            self.remove_images(user, message_id)
+        self.set(RECENT, None)
+
+    # The chum is read, deleted and uncounted inside commit's transaction, so
+    # its counters can never disagree with it. Writes planned after this one,
+    # e.g. an edited chum logged again, are applied after the deletion.
+    def delete_chum(self, message_id):
+        self.deletions.append(message_id)
+
+    # Written with the batch it follows, so a resumed backfill never replays
+    # a committed message. 
+    def save_checkpoint(self, latest, count):
+        self.plan_write(pymongo.UpdateOne(
+            filter={"_id": self.loc_id},
+            update={"$set": {"latest": latest, "count": count, "date": datetime.utcnow()}},
+            upsert=True
+        ), CHECKPOINT_COLLECTION_NAME)
+
+    # The unique (loc_id, mid) index makes this insert the guard for the rest
+    # of the session: if the chum was already logged, commit writes nothing. 
     def add_message(self, message_id, message):
-        self.set(f"{MESSAGES}.{message_id}", message)
+        self.plan_write(pymongo.InsertOne(
+            dict(message, loc_id=self.loc_id, mid=message_id)
+        ), CHUM_COLLECTION_NAME)
 
     def set_manager(self, user): 
         self.set(f"{MANAGER}", user)
@@ -225,9 +597,56 @@ class SpotDatabase():
     def pop(self, path, from_front: bool):
         self.update_value(path, "$pop", -1 if from_front else 1)
 
-    def push_write(self):
-        self.collection.bulk_write(self.operations)
-        self.operations.clear()
+    # Returns False if nothing was written because a chum in this session had
+    # already been logged, e.g. when Slack redelivers an event. 
+    def commit(self):
+        planned, pending, deletions = self.operations, self.pending, self.deletions
+        self.operations, self.pending, self.deletions = {}, PendingWrites(), []
+        if not deletions and not pending and not any(planned.values()):
+            return True
+
+        write_behind = self.database.write_behind if self.write_behind else None
+        if write_behind and deletions:
+            # A buffered image has to be written before it can be removed
+            write_behind.flush(self.loc_id)
+
+        # Runs again from scratch if the transaction is retried
+        def write(session):
+            undo = ChumSession(self.database, self.loc_id)
+            for message_id in deletions:
+                message = self.database.chums.find_one_and_delete(
+                    filter={"loc_id": self.loc_id, "mid": message_id},
+                    projection={"_id": False},
+                    session=session
+                )
+                if message:
+                    undo.unrecord_chum(message_id, message)
+
+            # An edit's decrements and increments of the same documents cancel
+            # out here, and documents left unchanged are not written
+            increments = PendingWrites()
+            increments.merge(undo.pending)
+            if not write_behind:
+                increments.merge(pending)
+            batches = [undo.operations, planned, increments.operations()]
+            # Chums go first so a duplicate stops the other writes even without transactions
+            operations = sorted(
+                [(name, [operation for batch in batches for operation in batch.get(name, [])]) for name in set().union(*batches)],
+                key=lambda operation: operation[0] != CHUM_COLLECTION_NAME
+            )
+            for name, writes in operations:
+                if writes:
+                    self.database.db.get_collection(name).bulk_write(writes, session=session)
+
+        try:
+            self.database.run_atomically(write)
+        except pymongo.errors.BulkWriteError as e:
+            if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                raise
+            return False
+        if write_behind:
+            write_behind.add(pending)
+        return True
 
 class ReferendumDatabase():
 
@@ -239,16 +658,180 @@ class ReferendumDatabase():
     def store_referendum(self, referendum):
         self.collection.insert_one(referendum)
 
-    def expired_referenda(self):
-        expired = self.collection.find({"date" : {"$lt" : datetime.utcnow() - timedelta(seconds=self.expiration_seconds)} })
-        referenda = []
-        ids = []
-        for referendum in expired: 
-            referenda.append(referendum)
-            ids.append(referendum["_id"])
+    def expired_filter(self, now):
+        return {
+            "date": {"$lt": now - timedelta(seconds=self.expiration_seconds)},
+            "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]
+        }
+
+    # Leases up to limit expired referenda, oldest first, to owner. Other
+    # workers skip them until the lease runs out, so a referendum whose
+    # processing failed is retried after lease_seconds. Three round trips
+    # however many are claimed; ones another worker leased in between are
+    # left out.
+    def claim_expired(self, owner, lease_seconds, limit):
+        now = datetime.utcnow()
+        candidates = [referendum["_id"] for referendum in self.collection.find(
+            filter=self.expired_filter(now),
+            projection={"_id": True},
+            sort=[("date", pymongo.ASCENDING)],
+            limit=limit
+        )]
+        if not candidates:
+            return []
+        lease = {"lease_owner": owner, "lease_until": now + timedelta(seconds=lease_seconds)}
+        self.collection.update_many(
+            filter=dict(self.expired_filter(now), _id={"$in": candidates}),
+            update={"$set": lease}
+        )
+        return list(self.collection.find(dict(lease, _id={"$in": candidates}), sort=[("date", pymongo.ASCENDING)]))
+
+    # Extends the leases of referenda their owner still holds
+    def renew(self, referenda, lease_seconds):
+        if referenda:
+            self.collection.update_many(
+                filter={"_id": {"$in": [referendum["_id"] for referendum in referenda]}, "lease_owner": referenda[0]["lease_owner"]},
+                update={"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=lease_seconds)}}
+            )
+
+    def count_open(self, team_id):
+        return self.collection.count_documents({"team_id": team_id})
+
+    def complete(self, referenda):
+        if referenda:
+            self.collection.delete_many({
+                "_id": {"$in": [referendum["_id"] for referendum in referenda]},
+                "lease_owner": referenda[0]["lease_owner"]
+            })
 
-        self.collection.delete_many({ "_id" : { "$in": ids } })
-        return referenda
+    # When the oldest unleased referendum expires, or None if there are none.
+    def next_expiration(self):
+        oldest = self.collection.find_one(
+            filter={"lease_until": None},
+            projection={"date": True},
+            sort=[("date", pymongo.ASCENDING)]
+        )
+        if not oldest:
+            return None
+        return oldest["date"] + timedelta(seconds=self.expiration_seconds)
+
+# Each workspace's chum and image totals, kept up to date by ChumSession, for
+# per-workspace stats and quotas.
+class TenantDatabase():
+    def __init__(self, client):
+        db = client.get_database(MAIN_DATABASE_NAME)
+        self.db = db
+        self.collection = db.get_collection(TENANT_COLLECTION_NAME)
+        self.cache = TTLCache(TENANT_CACHE_SIZE, TENANT_CACHE_SECONDS)
+
+    # May be up to TENANT_CACHE_SECONDS old
+    def get_usage(self, team_id):
+        usage = self.cache.get(team_id)
+        if usage is None:
+            usage = self.collection.find_one({"team_id": team_id}, projection={"_id": False}) or {"team_id": team_id}
+            self.cache.set(team_id, usage)
+        return usage
+
+    def get_top(self, n):
+        return list(self.collection.find({}, projection={"_id": False}, sort=[("chums", pymongo.DESCENDING)], limit=n))
+
+    def count_channels(self, team_id):
+        return self.db.get_collection(MAIN_COLLECTION_NAME).count_documents({"loc_id": team_range(team_id)})
+
+    # Recomputes a workspace's totals from its documents, e.g. after a
+    # migration. Chums logged meanwhile may be counted twice or not at all.
+    def recount(self, team_id):
+        usage = {
+            "team_id": team_id,
+            "chums": self.db.get_collection(CHUM_COLLECTION_NAME).count_documents({"loc_id": team_range(team_id)}),
+            "images": self.db.get_collection(IMAGE_COLLECTION_NAME).count_documents({"loc_id": team_range(team_id)})
+        }
+        self.collection.replace_one({"team_id": team_id}, usage, upsert=True)
+        self.cache.invalidate(team_id)
+        return usage
+
+# Named leases with an expiry, used to elect one worker across processes and
+# hosts to run a background job. 
+class LeaseDatabase():
+    def __init__(self, client):
+        db = client.get_database(MAIN_DATABASE_NAME)
+        self.collection = db.get_collection(LEASE_COLLECTION_NAME)
+
+    # Takes or renews the lease. Returns False while another owner holds it.
+    def acquire(self, name, owner, seconds):
+        now = datetime.utcnow()
+        try:
+            self.collection.find_one_and_update(
+                filter={"_id": name, "$or": [{"owner": owner}, {"until": {"$lt": now}}]},
+                update={"$set": {"owner": owner, "until": now + timedelta(seconds=seconds)}},
+                upsert=True
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    def release(self, name, owner):
+        self.collection.delete_one({"_id": name, "owner": owner})
+
+# Remembers which Slack events have been handled, in a bounded in-process LRU
+# in front of a collection whose TTL index forgets them once Slack has 
+# stopped retrying. 
+class ProcessedEventDatabase():
+    def __init__(self, client, expiration_seconds):
+        db = client.get_database(MAIN_DATABASE_NAME)
+        self.collection = db.get_collection(PROCESSED_EVENT_COLLECTION_NAME)
+        self.recent = TTLCache(PROCESSED_EVENT_CACHE_SIZE, expiration_seconds)
+
+    # Returns True the first time an event is claimed, False for redeliveries.
+    def claim(self, event_id):
+        if self.recent.get(event_id):
+            return False
+        self.recent.set(event_id, True)
+        try:
+            self.collection.insert_one({"_id": event_id, "date": datetime.utcnow()})
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    # Lets a redelivery through again after the first attempt failed.
+    def release(self, event_id):
+        self.recent.invalidate(event_id)
+        self.collection.delete_one({"_id": event_id})
+
+def day_of(timestamp):
+    return datetime.utcfromtimestamp(float(timestamp)).strftime(DAY_FORMAT)
+
+# Returns (start_day, end_day, label) for "week" (since Monday) or "month" 
+# (since the 1st), in UTC. 
+def window_days(window, today=None):
+    today = today or datetime.utcnow().date()
+    if window == "week":
+        start = today - timedelta(days=today.weekday())
+        label = "this week"
+    else:
+        start = today.replace(day=1)
+        label = "this month"
+    return start.strftime(DAY_FORMAT), today.strftime(DAY_FORMAT), label
+
+def parse_day(word):
+    try:
+        return datetime.strptime(word, DAY_FORMAT).strftime(DAY_FORMAT)
+    except ValueError:
+        return None
+
+# What is kept about a chum's image file. Images logged before this was kept
+# are bare url_private strings.
+def image_from_file(file):
+    return remove_nones({
+        "url": file["url_private"],
+        "file_id": file.get("id"),
+        "width": file.get("original_w"),
+        "height": file.get("original_h"),
+        "mimetype": file.get("mimetype")
+    })
+
+def image_record(image):
+    return {"url": image} if isinstance(image, str) else image
 
 def message_id(timestamp):
     return hashlib.sha256(bytes(timestamp, encoding="utf-8")).hexdigest()
@@ -256,14 +839,15 @@ def message_id(timestamp):
 def comp(pattern):
     return re.compile(pattern, re.IGNORECASE)
 
-def get_display_name(client, user):
+def get_display_name(client, team_id, user):
+    return display_names.get_or_load((team_id, user), lambda: load_display_name(client, user))
+
+def load_display_name(client, user):
     try:
         profile = client.users_profile_get(user=user)['profile']
         return profile['display_name'] or profile['real_name']
     except Exception as e:
-        print("couldn't find: ", user, e)
+        logger.warning("Couldn't find display name", extra=fields(user=user, error=str(e)))
 
-def get_bot_user(client):
-    bot_info = client.auth_test()
-    bot_user = bot_info["user_id"]
-    return bot_user
\ No newline at end of file
+def get_bot_user(client, team_id):
+    return bot_users.get_or_load(team_id, lambda: client.auth_test()["user_id"])
\ No newline at end of file
@@ -0,0 +1,180 @@
+from collections import Counter
+from logs import fields
+import logging, pymongo, pymongo.errors, threading
+
+logger = logging.getLogger(__name__)
+
+
+# Upserted increments and inserts, which can be applied in any order. Repeated
+# increments of the same document are added together into one update.
+class PendingWrites():
+    def __init__(self):
+        # (collection, filter items) -> (filter, {path: amount})
+        self.increments = {}
+        # collection -> documents
+        self.inserts = {}
+
+    def __len__(self):
+        return len(self.increments) + sum(len(documents) for documents in self.inserts.values())
+
+    def increment(self, collection, filter, path, amount):
+        _, amounts = self.increments.setdefault((collection, tuple(sorted(filter.items()))), (filter, {}))
+        amounts[path] = amounts.get(path, 0) + amount
+
+    def insert(self, collection, document):
+        self.inserts.setdefault(collection, []).append(document)
+
+    def merge(self, other):
+        for (collection, _), (filter, amounts) in other.increments.items():
+            for path, amount in amounts.items():
+                self.increment(collection, filter, path, amount)
+        for collection, documents in other.inserts.items():
+            self.inserts.setdefault(collection, []).extend(documents)
+
+    # Removes and returns the writes for one location, or all of them.
+    def take(self, loc_id=None):
+        taken = PendingWrites()
+        for key, (filter, amounts) in list(self.increments.items()):
+            if loc_id is None or filter.get("loc_id") == loc_id:
+                taken.increments[key] = self.increments.pop(key)
+        for collection, documents in list(self.inserts.items()):
+            kept = [document for document in documents if loc_id is not None and document["loc_id"] != loc_id]
+            if len(kept) < len(documents):
+                taken.inserts[collection] = [document for document in documents if loc_id is None or document["loc_id"] == loc_id]
+            if kept:
+                self.inserts[collection] = kept
+            else:
+                del self.inserts[collection]
+        return taken
+
+    # (collection, operation, increment key or None, inserted document or None)
+    # for every write, in a fixed order. Increments that add up to nothing
+    # are left out.
+    def entries(self):
+        for key, (filter, amounts) in self.increments.items():
+            amounts = {path: amount for path, amount in amounts.items() if amount}
+            if amounts:
+                yield key[0], pymongo.UpdateOne(filter, {"$inc": amounts}, upsert=True), key, None
+        for collection, documents in self.inserts.items():
+            for document in documents:
+                yield collection, pymongo.InsertOne(dict(document)), None, document
+
+    # collection -> bulk write operations, never empty
+    def operations(self):
+        operations = {}
+        for collection, operation, _, _ in self.entries():
+            operations.setdefault(collection, []).append(operation)
+        return operations
+
+    # The writes left once the first applied[collection] operations of each
+    # collection, in operations() order, have been written.
+    def unapplied(self, applied):
+        rest = PendingWrites()
+        seen = Counter()
+        for collection, _, key, document in self.entries():
+            seen[collection] += 1
+            if seen[collection] <= applied.get(collection, 0):
+                continue
+            if key:
+                filter, amounts = self.increments[key]
+                rest.increments[key] = (filter, dict(amounts))
+            else:
+                rest.insert(collection, document)
+        return rest
+
+
+# Holds back the counter increments and image inserts of committed chums and
+# writes them together, every flush_seconds or once max_pending writes are
+# waiting. A burst of chums in one channel then costs one bulk write per
+# collection instead of one per chum. Reads flush their location first, so
+# this process always sees its own writes; other processes may lag by up to
+# flush_seconds. Writes still waiting are lost if the process is killed.
+class WriteBehind():
+    def __init__(self, database, flush_seconds, max_pending):
+        self.database = database
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.pending = PendingWrites()
+        self.lock = threading.Lock()
+        # Held for a whole flush, so a read never misses writes in flight
+        self.flushing = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+        # Called after writes are added or taken, without the lock held
+        self.on_change = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, writes):
+        with self.lock:
+            self.pending.merge(writes)
+            full = len(self.pending) >= self.max_pending
+        self.changed()
+        if full:
+            self.wake.set()
+
+    def depth(self):
+        with self.lock:
+            return len(self.pending)
+
+    def changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def flush(self, loc_id=None):
+        with self.flushing:
+            with self.lock:
+                writes = self.pending.take(loc_id)
+            self.changed()
+            operations = writes.operations()
+            if not operations:
+                return
+            # collection -> operations known to be written
+            applied = {}
+
+            def write(session):
+                applied.clear()
+                for name, batch in operations.items():
+                    # Unknown until the bulk write returns or says where it stopped
+                    applied[name] = len(batch)
+                    self.database.db.get_collection(name).bulk_write(batch, session=session)
+
+            try:
+                self.database.run_atomically(write)
+            except Exception as e:
+                if self.database.transactions:
+                    # The transaction wrote nothing
+                    applied.clear()
+                elif isinstance(e, pymongo.errors.BulkWriteError):
+                    # Ordered bulk writes stop at their first error
+                    failed = next(reversed(applied))
+                    applied[failed] = e.details["writeErrors"][0]["index"]
+                retry = writes.unapplied(applied)
+                if len(retry) < len(writes):
+                    logger.error("Some buffered writes may have been lost", extra=fields(
+                        attempted=len(writes), retried=len(retry)))
+                # Try the rest again with the next flush
+                with self.lock:
+                    self.pending.merge(retry)
+                self.changed()
+                raise
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Encountered an exception while flushing buffered writes", extra=fields(pending=self.depth()))
+
+    # Writes everything still waiting, then stops the flushing thread.
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()